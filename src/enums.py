@@ -9,6 +9,7 @@ class MessageType(Enum):
     REQUEST = "request"
     RESPONSE = "response"
     INFO = "info"
+    CANCEL = "cancel"
     
 class GenType(Enum):
     TEXT2IMG = "text2img"
@@ -20,10 +21,12 @@ class GenStatus(Enum):
     ERROR = "error"
     QUEUED = "queued"
     GENERATING = "generating"
+    CANCELLED = "cancelled"
     
 class ContentType(Enum):
     TEXT = "text"
     BASE64 = "base64"
+    BINARY = "binary"
     IMAGE_URL = "image_url"
 
 class ExecutorType(Enum):
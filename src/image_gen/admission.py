@@ -0,0 +1,81 @@
+import logging
+
+from time import perf_counter
+from typing import Dict, Union
+
+from enums import ExecutorType, Service
+from utils.metrics import Metrics
+
+from .request import GenerationRequest
+
+class AdmissionControl():
+    '''Rejects new requests the generator cannot serve in time and sheds stale queued ones'''
+    max_queue_depth: Dict[ExecutorType, int] = {}
+    '''Max queued requests per executor type'''
+    max_service_queue: Dict[Service, int] = {}
+    '''Max queued requests per service and executor type'''
+    eta_slo: Dict[bool, float] = {}
+    '''Max predicted wait in seconds by premium'''
+    general_deadline: float = 0
+    '''Max seconds a general request may wait for a GPU, 0 disables'''
+
+    @classmethod
+    def configure(
+            cls,
+            max_queue_depth: Dict[ExecutorType, int] = None,
+            max_service_queue: Dict[Service, int] = None,
+            eta_slo: Dict[bool, float] = None,
+            general_deadline: float = 0
+        ) -> None:
+        cls.max_queue_depth = max_queue_depth or {}
+        cls.max_service_queue = max_service_queue or {}
+        cls.eta_slo = eta_slo or {}
+        cls.general_deadline = general_deadline
+
+    @classmethod
+    def check(cls, request: GenerationRequest, queue, queue_work: float) -> Union[str, None]:
+        '''Returns rejection reason or None if request may be queued.
+
+        `queue_work` is predicted work queued before the request, predicted wait
+        is left in `request.avg_time`.
+        '''
+        premium = bool(request.premium)
+        request.avg_time = request.predict_wait(queue_work + request.work)
+
+        limit = cls.max_queue_depth.get(request.executor)
+        if limit and queue.get_total_size() >= limit:
+            return cls.reject(request, 'queue_depth', f'Queue is full ({limit} requests)')
+
+        limit = cls.max_service_queue.get(request.service)
+        if limit and queue.get_service_size(request.service) >= limit:
+            return cls.reject(request, 'service_queue',\
+                f'Queue of {request.service.value} is full ({limit} requests)')
+
+        slo = cls.eta_slo.get(premium)
+        if slo and request.avg_time is not None and request.avg_time > slo:
+            return cls.reject(request, 'slo',\
+                f'Predicted wait {request.avg_time:.0f}s exceeds {slo:.0f}s')
+        return None
+
+    @staticmethod
+    def reject(request: GenerationRequest, reason: str, message: str) -> str:
+        logging.warning(f'Rejecting request from {request.service.name}: {message}')
+        Metrics.rejected.inc(request.executor.value, request.service.value,\
+            '1' if request.premium else '0', reason)
+        return message
+
+    @classmethod
+    def expired(cls, request: GenerationRequest) -> bool:
+        '''General request waited longer than `general_deadline`'''
+        if request.premium or cls.general_deadline <= 0 or request.queued_at is None:
+            return False
+        return perf_counter() - request.queued_at > cls.general_deadline
+
+    @classmethod
+    async def expire(cls, request: GenerationRequest, queue) -> None:
+        '''Fails request dropped from queue before reaching a GPU'''
+        queue.complete(request)
+        cls.reject(request, 'expired', f'Request:{str(request.object_id)} expired in queue')
+        async with request.lock:
+            await request.set_error(f'Request expired after {cls.general_deadline:.0f}s in queue')
+            await request.send_to_client()
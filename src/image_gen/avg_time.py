@@ -3,6 +3,10 @@ import logging
 
 from datetime import datetime
 
+from utils.metrics import Metrics
+
+from .cost_model import CostModel
+
 class AvgTimeCalc():
     auto_avg_time = 4
     kand_avg_time = 4
@@ -27,6 +31,11 @@ class AvgTimeCalc():
             executors = cls.executors[executor.exec_type]
         executors.append(executor)
 
+    @classmethod
+    def get_slots(cls, exec_type) -> int:
+        '''Concurrent requests alive executors of the type can take'''
+        return sum(executor.slots for executor in cls.executors.get(exec_type, []))
+
     @classmethod
     def update_ratio(cls):
         cls.ratio = tuple(map(int, os.getenv('GENERAL_PREMIUM_RATIO').split()))
@@ -40,6 +49,10 @@ class AvgTimeCalc():
             time_finish = datetime.now()
             time_diff = time_finish - time_start
             cls.add_auto_time_diff(time_diff.total_seconds())
+            # Executor and request
+            executor, request = args[0], args[1]
+            CostModel.observe(executor, request.work, request.pixels, time_diff.total_seconds())
+            Metrics.generation.observe(time_diff.total_seconds(), *Metrics.request_labels(request))
         return wrapped
     
     @classmethod
@@ -50,6 +63,10 @@ class AvgTimeCalc():
             time_finish = datetime.now()
             time_diff = time_finish - time_start
             cls.add_kand_time_diff(time_diff.total_seconds())
+            # Executor and request
+            executor, request = args[0], args[1]
+            CostModel.observe(executor, request.work, request.pixels, time_diff.total_seconds())
+            Metrics.generation.observe(time_diff.total_seconds(), *Metrics.request_labels(request))
         return wrapped
 
     @classmethod
@@ -0,0 +1,112 @@
+import re
+import logging
+
+from typing import Dict, List, Tuple
+
+from enums import ExecutorType, GenType
+
+class CostModel():
+    '''Predicts generation time from payload and GPU profile (`data/gpu.json`).
+
+    Work is measured in 512x512 steps: `steps * batch * width * height / 512^2`.
+    GPU profile gives it/sec per resolution, which turns into work per second.
+    Every executor keeps a learned factor correcting the profile by observed timings.
+    '''
+    base_pixels = 512 * 512
+    default_steps = {
+        ExecutorType.AUTOMATIC1111: 20,
+        ExecutorType.KANDINSKY: 50
+    }
+    default_rate = 4.0
+    '''It/sec at 512x512 for unknown GPUs'''
+    learning_rate = 0.2
+
+    profiles: Dict[str, List[Tuple[int, float]]] = {}
+    '''GPU -> [(pixels, work per second)] sorted by pixels'''
+    factors: Dict[str, float] = {}
+    '''Executor name -> observed time / predicted time'''
+
+    @classmethod
+    def load(cls, gpus: dict) -> None:
+        for gpu, profile in gpus.items():
+            rates = []
+            for resolution, its in profile.items():
+                match = re.fullmatch(r'(\d+)x(\d+)', resolution)
+                if match is None:
+                    continue
+                pixels = int(match.group(1)) * int(match.group(2))
+                rates.append((pixels, float(its) * pixels / cls.base_pixels))
+            cls.profiles[str(gpu)] = sorted(rates)
+        logging.info(f'Loaded {len(cls.profiles)} GPU profiles')
+
+    @staticmethod
+    def get_value(payload: dict, keys: Tuple[str, ...], default):
+        for key in keys:
+            value = payload.get(key)
+            if value is not None:
+                return value
+        return default
+
+    @classmethod
+    def get_pixels(cls, payload: dict) -> int:
+        payload = payload or {}
+        try:
+            width = int(cls.get_value(payload, ('width', 'w'), 512))
+            height = int(cls.get_value(payload, ('height', 'h'), 512))
+            return max(width * height, 1)
+        except (TypeError, ValueError):
+            return cls.base_pixels
+
+    @classmethod
+    def work(
+            cls,
+            exec_type: ExecutorType,
+            gen_type: GenType,
+            payload: dict
+        ) -> float:
+        '''Request work in 512x512 steps'''
+        payload = payload or {}
+        try:
+            steps = float(cls.get_value(payload, ('steps', 'num_steps'), cls.default_steps[exec_type]))
+            batch = float(payload.get('batch_size') or 1) * float(payload.get('n_iter') or 1)
+            # A1111 img2img runs only `denoising_strength` part of steps
+            if exec_type == ExecutorType.AUTOMATIC1111 and gen_type == GenType.IMG2IMG:
+                steps *= float(payload.get('denoising_strength') or 0.75)
+        except (TypeError, ValueError):
+            steps, batch = cls.default_steps[exec_type], 1
+        return max(steps, 1) * max(batch, 1) * cls.get_pixels(payload) / cls.base_pixels
+
+    @classmethod
+    def rate(cls, executor, pixels: int = None) -> float:
+        '''Executor slot throughput in work per second at given resolution'''
+        if pixels is None:
+            pixels = cls.base_pixels
+        profile = cls.profiles.get(str(executor.gpu))
+        if profile:
+            # Nearest profiled resolution
+            _, rate = min(profile, key=lambda entry: abs(entry[0] - pixels))
+        else:
+            rate = cls.default_rate
+        return rate / cls.factors.get(executor.name, 1.0)
+
+    @classmethod
+    def predict(cls, executor, exec_type: ExecutorType, gen_type: GenType, payload: dict) -> float:
+        '''Predicted seconds for request on the executor'''
+        return cls.work(exec_type, gen_type, payload) / cls.rate(executor, cls.get_pixels(payload))
+
+    @classmethod
+    def capacity(cls, executors: list, pixels: int = None) -> float:
+        '''Total work per second of executors, every slot counts'''
+        return sum(cls.rate(executor, pixels) * executor.slots for executor in executors)
+
+    @classmethod
+    def observe(cls, executor, work: float, pixels: int, seconds: float) -> None:
+        '''Learns executor factor from observed generation time'''
+        if work <= 0 or seconds <= 0:
+            return
+        factor = cls.factors.get(executor.name, 1.0)
+        # Prediction by GPU profile alone
+        predicted = work / (cls.rate(executor, pixels) * factor)
+        # Clamping outliers (timeouts, cold starts)
+        ratio = min(max(seconds / predicted, 0.1), 10.0)
+        cls.factors[executor.name] = (1 - cls.learning_rate) * factor + cls.learning_rate * ratio
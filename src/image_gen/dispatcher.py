@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+from typing import List
+
+from .queue import RequestQueue
+from .request import GenerationRequest
+from .scheduler import FifoScheduler
+from .cost_model import CostModel
+from .health import BreakerState
+from .executors.executor import AbstractExecutor
+
+class Dispatcher():
+    '''Least-expected-completion-time dispatch.
+
+    Takes requests from the shared queue in scheduler order and hands each one
+    to the executor predicted to finish it first, by learned throughput and
+    backlog. Executors keep at most `depth` requests in their inbox beyond
+    free slots, the rest stays in the shared queue.
+    '''
+    queue: RequestQueue
+    executors: List[AbstractExecutor]
+    depth: int
+    changed: asyncio.Event
+
+    def __init__(
+            self,
+            queue: RequestQueue,
+            executors: List[AbstractExecutor],
+            depth: int = 1
+        ) -> None:
+        self.queue = queue
+        self.executors = executors
+        self.depth = depth
+        self.changed = asyncio.Event()
+        for executor in executors:
+            # Inbox is short, payloads stay in memory
+            executor.inbox = RequestQueue((0, 0), FifoScheduler(), spill=False)
+            executor.notify = self.changed.set
+
+    def has_room(self, executor: AbstractExecutor) -> bool:
+        return executor.inbox.get_total_size() + executor.busy < executor.slots + self.depth
+
+    def expected_completion(self, executor: AbstractExecutor, request: GenerationRequest) -> float:
+        '''Seconds until request would be done on executor'''
+        backlog = executor.inbox.work + executor.in_flight_work + request.work
+        return backlog / CostModel.capacity([executor], request.pixels)
+
+    async def choose(self, request: GenerationRequest) -> AbstractExecutor:
+        while True:
+            self.changed.clear()
+            candidates = [executor for executor in self.executors\
+                if executor.breaker.state != BreakerState.OPEN and self.has_room(executor)]
+            if candidates:
+                return min(candidates, key=lambda executor: self.expected_completion(executor, request))
+            # Waiting for a slot or executor state change
+            await self.changed.wait()
+
+    async def loop(self) -> None:
+        while True:
+            try:
+                request = await self.queue.get_request()
+                try:
+                    executor = await self.choose(request)
+                except asyncio.CancelledError:
+                    self.queue.put_back(request)
+                    raise
+                if request.cancelled:
+                    # Cancelled while waiting for an executor
+                    self.queue.complete(request)
+                    continue
+                logging.debug(f'Dispatching request:{str(request.object_id)} to {executor.name}')
+                if request.premium:
+                    executor.inbox.put_premium(request)
+                else:
+                    executor.inbox.put_general(request)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'Error in dispatcher loop\n[{type(e)}] {e}')
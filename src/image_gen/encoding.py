@@ -0,0 +1,109 @@
+import os
+import re
+
+from typing import Dict, List, Tuple, Union
+
+from enums import Service
+
+from .request import GenerationRequest
+
+class OutputEncoding():
+    '''Format, quality and max size of result images and their variants.
+
+    Defaults come from env, services may override them (`data/encoding.json`)
+    and requests may override both with `settings.encoding`. Variants
+    (thumbnails, previews) are encoded and uploaded next to the main image.
+    '''
+    formats: Dict[str, Tuple[str, str]] = {
+        'jpeg': ('jpg', 'image/jpeg'),
+        'webp': ('webp', 'image/webp'),
+        'png': ('png', 'image/png')
+    }
+    '''Format -> (file extension, content type)'''
+    default: dict = {
+        'format': 'jpeg',
+        'quality': 75,
+        'progressive': False,
+        'max_size': 0
+    }
+    '''Options of main image'''
+    variants: Dict[str, dict] = {}
+    '''Default variants by name'''
+    services: Dict[Service, dict] = {}
+    max_variants = 4
+    variant_name = re.compile(r'^[a-z0-9]{1,16}$')
+
+    @classmethod
+    def configure(cls, services: dict = None) -> None:
+        '''Reads defaults from env, `services` are overrides by service value'''
+        cls.default = cls.clean({
+            'format': os.getenv('IMAGE_FORMAT', 'jpeg'),
+            'quality': int(os.getenv('IMAGE_QUALITY', 75)),
+            'progressive': bool(int(os.getenv('IMAGE_PROGRESSIVE', 0))),
+            'max_size': int(os.getenv('IMAGE_MAX_SIZE', 0))
+        }, cls.default)
+        # IMAGE_VARIANTS=thumb:256 preview:1024:webp
+        variants = {}
+        for variant in os.getenv('IMAGE_VARIANTS', '').split():
+            values = variant.split(':')
+            variants[values[0]] = {'max_size': int(values[1])}
+            if len(values) > 2:
+                variants[values[0]]['format'] = values[2]
+        cls.variants = cls.clean_variants(variants)
+        cls.services = {Service(service): options for service, options in (services or {}).items()}
+
+    @classmethod
+    def clean(cls, options: dict, base: dict) -> dict:
+        '''Valid `options` on top of `base`, invalid values are ignored'''
+        result = dict(base)
+        if options.get('format') in cls.formats:
+            result['format'] = options['format']
+        quality = options.get('quality')
+        if isinstance(quality, int) and 1 <= quality <= 100:
+            result['quality'] = quality
+        if isinstance(options.get('progressive'), bool):
+            result['progressive'] = options['progressive']
+        max_size = options.get('max_size')
+        if isinstance(max_size, int) and max_size >= 0:
+            result['max_size'] = max_size
+        return result
+
+    @classmethod
+    def clean_variants(cls, variants) -> Dict[str, dict]:
+        result = {}
+        if not isinstance(variants, dict):
+            return result
+        for name, variant in variants.items():
+            if len(result) < cls.max_variants and isinstance(variant, dict)\
+                    and cls.variant_name.match(str(name)):
+                result[name] = variant
+        return result
+
+    @classmethod
+    def resolve(cls, request: GenerationRequest) -> dict:
+        '''Encoding of request with service and request overrides, variants under `variants`'''
+        encoding = dict(cls.default)
+        variants = cls.variants
+        for options in (cls.services.get(request.service), (request.settings or {}).get('encoding')):
+            if not isinstance(options, dict):
+                continue
+            encoding = cls.clean(options, encoding)
+            if 'variants' in options:
+                variants = cls.clean_variants(options['variants'])
+        # Variants inherit main options unless they set their own
+        encoding['variants'] = {name: cls.clean(variant, {**encoding, 'max_size': 0})\
+            for name, variant in variants.items()}
+        return encoding
+
+    @classmethod
+    def outputs(cls, encoding: dict, file_name: str) -> List[Tuple[Union[str, None], str, dict]]:
+        '''(variant name, file name, options) of main image (None name) and its variants'''
+        stem = os.path.splitext(file_name)[0]
+        outputs = [(None, f'{stem}.{cls.formats[encoding["format"]][0]}', encoding)]
+        for name, variant in encoding['variants'].items():
+            outputs.append((name, f'{stem}_{name}.{cls.formats[variant["format"]][0]}', variant))
+        return outputs
+
+    @classmethod
+    def content_type(cls, options: dict) -> str:
+        return cls.formats[options['format']][1]
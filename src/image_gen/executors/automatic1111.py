@@ -1,15 +1,18 @@
-import httpx
-import base64
 import logging
 import asyncio
 
+from typing import List
+from datetime import datetime
+
 from enums import *
 
 from .executor import AbstractExecutor
+from ..queue import RequestQueue
 from ..request import GenerationRequest
 from ..avg_time import AvgTimeCalc
-
-client = httpx.AsyncClient()
+from ..cost_model import CostModel
+from utils.metrics import Metrics
+from utils.json_images import JsonImagesDecoder
 
 class Automatic1111Executor(AbstractExecutor):
     def __init__(
@@ -19,13 +22,17 @@ class Automatic1111Executor(AbstractExecutor):
             gpu: str, 
             timeout: float, 
             model: str, 
-            endpoint: str
+            endpoint: str,
+            batch_window: float = 0,
+            max_batch_size: int = 1,
+            slots: int = 1
         ) -> None:
-        super().__init__(name, executor_type, gpu, timeout, model, endpoint)
+        super().__init__(name, executor_type, gpu, timeout, model, endpoint,\
+            batch_window, max_batch_size, slots)
 
     async def ping(self):
         try: 
-            response = await client.get(url=self.endpoint[:-8], timeout=5)
+            response = await self.control_client.get(url=self.endpoint[:-8], timeout=5)
             if response.content == b'{"detail":"Not Found"}':
                 return True
             return False
@@ -33,22 +40,38 @@ class Automatic1111Executor(AbstractExecutor):
             logging.debug(type(e))
             return False
 
+    async def interrupt(self) -> None:
+        try:
+            await self.control_client.post(f'{self.endpoint}/interrupt', timeout=5)
+            logging.info(f'{self.name} interrupted')
+        except Exception as e:
+            logging.error(f'Cannot interrupt {self.name}: [{type(e)}] {e}')
+
+    async def post_for_images(self, url: str, payload: dict, timeout: float) -> List[bytes]:
+        '''Sends api request, decodes `images` while response is streamed'''
+        async with self.client.stream('POST', url, json=payload,\
+                timeout=self.request_timeout(timeout)) as response:
+            if response.status_code != 200:
+                await response.aread()
+                self.check_response(response)
+            decoder = JsonImagesDecoder()
+            async for chunk in response.aiter_bytes():
+                decoder.feed(chunk)
+        images = decoder.close()
+        if not images:
+            raise Exception('Automatic1111 returned no images')
+        return images
+
     @AvgTimeCalc.calc_auto_time_diff
     async def text2img(self, request: GenerationRequest):
         # Sending api request
         payload = request.payload
-        response = await client.post(url=f'{self.endpoint}/txt2img',\
-            json=payload, timeout=self.timeout, follow_redirects=True)
+        images = await self.post_for_images(f'{self.endpoint}/txt2img', payload, self.timeout)
         
         # Getting result
-        result = response.json()
-        image_bytes = base64.b64decode(result['images'][0].split(",",1)[0])
+        image_bytes = images[0]
         file_name = f'{str(request.object_id)}.jpg'
 
-        # Saving locally if needed
-        if self.save_images_locally:
-            self.save_locally(image_bytes, file_name)
-
         loop = asyncio.get_event_loop()
         loop.create_task(self.save_to_s3_with_event(request, image_bytes, file_name))
 
@@ -63,18 +86,12 @@ class Automatic1111Executor(AbstractExecutor):
     async def img2img(self, request: GenerationRequest):
         # Sending api request
         payload = request.payload
-        response = await client.post(url=f'{self.endpoint}/img2img',\
-            json=payload, timeout=self.timeout, follow_redirects=True)
+        images = await self.post_for_images(f'{self.endpoint}/img2img', payload, self.timeout)
         
         # Getting result
-        result = response.json()
-        image_bytes = base64.b64decode(result['images'][0].split(",",1)[0])
+        image_bytes = images[0]
         file_name = f'{str(request.object_id)}.jpg'
 
-        # Saving locally if needed
-        if self.save_images_locally:
-            self.save_locally(image_bytes, file_name)
-
         loop = asyncio.get_event_loop()
         loop.create_task(self.save_to_s3_with_event(request, image_bytes, file_name))
 
@@ -83,4 +100,89 @@ class Automatic1111Executor(AbstractExecutor):
 
         # # Mark request as done
         # async with request.lock:
-        #     await request.set_ok(ContentType.IMAGE_URL, image_url, file_name)
\ No newline at end of file
+        #     await request.set_ok(ContentType.IMAGE_URL, image_url, file_name)
+
+    @staticmethod
+    def batch_seed(payload: dict) -> int:
+        '''Fixed seed of the payload, -1 for random'''
+        seed = payload.get('seed')
+        if seed is None or seed < 0:
+            return -1
+        return seed
+
+    @staticmethod
+    def batch_key(payload: dict) -> dict:
+        return {key: value for key, value in payload.items() if key != 'seed'}
+
+    def can_join_batch(
+            self,
+            requests: List[GenerationRequest],
+            request: GenerationRequest
+        ) -> bool:
+        '''Request joins batch if only its seed differs and the seed continues batch seeds'''
+        if request.gen_type != GenType.TEXT2IMG:
+            return False
+        first = requests[0].payload
+        if self.batch_key(first) != self.batch_key(request.payload):
+            return False
+        # A1111 gives `seed + i` to i-th image in batch
+        seed = self.batch_seed(first)
+        if seed == -1:
+            return self.batch_seed(request.payload) == -1
+        return self.batch_seed(request.payload) == seed + len(requests)
+
+    async def collect_batch(
+            self,
+            request: GenerationRequest,
+            queue: RequestQueue
+        ) -> List[GenerationRequest]:
+        requests = [request]
+        if self.max_batch_size <= 1 or request.gen_type != GenType.TEXT2IMG:
+            return requests
+        if request.payload.get('batch_size', 1) != 1 or request.payload.get('n_iter', 1) != 1:
+            return requests
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            candidate = await queue.get_request(timeout)
+            if candidate is None:
+                break
+            if not self.can_join_batch(requests, candidate):
+                # Leaving it for another executor
+                queue.put_back(candidate)
+                break
+            requests.append(candidate)
+
+        if len(requests) > 1:
+            logging.info(f'{self.name} batched {len(requests)} requests')
+        return requests
+
+    async def text2img_batch(self, requests: List[GenerationRequest]):
+        # Sending api request
+        payload = dict(requests[0].payload)
+        payload['batch_size'] = len(requests)
+        time_start = datetime.now()
+        images = await self.post_for_images(f'{self.endpoint}/txt2img',\
+            payload, self.timeout * len(requests))
+
+        # Getting result, grid (if returned) goes first
+        images = images[-len(requests):]
+        if len(images) != len(requests):
+            raise Exception(f'Expected {len(requests)} images, got {len(images)}')
+        time_diff = datetime.now() - time_start
+        for _ in requests:
+            AvgTimeCalc.add_auto_time_diff(time_diff.total_seconds() / len(requests))
+        CostModel.observe(self, sum(request.work for request in requests),\
+            requests[0].pixels, time_diff.total_seconds())
+        for request in requests:
+            Metrics.generation.observe(time_diff.total_seconds(), *Metrics.request_labels(request))
+
+        loop = asyncio.get_event_loop()
+        for request, image_bytes in zip(requests, images):
+            file_name = f'{str(request.object_id)}.jpg'
+
+            loop.create_task(self.save_to_s3_with_event(request, image_bytes, file_name))
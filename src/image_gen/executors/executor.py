@@ -1,13 +1,27 @@
+import httpx
+import random
 import asyncio
 import logging
+import importlib.util
 
 from enums import *
 from os import getenv
+from typing import List, Dict, Tuple, Union
+from time import perf_counter
 
 from utils.storage import Storage
+from utils.image_store import ImageStore
+from utils.compress import ImageCompressor
+from utils.metrics import Metrics
 from ..queue import RequestQueue
 from ..request import GenerationRequest
 from ..avg_time import AvgTimeCalc
+from ..result_cache import ResultCache
+from ..encoding import OutputEncoding
+from ..health import CircuitBreaker, BreakerState
+
+class BackendRequestError(Exception):
+    '''Backend rejected the request (4xx), executor itself is healthy'''
 
 class AbstractExecutor:
     name: str
@@ -16,13 +30,39 @@ class AbstractExecutor:
     model: str
     exec_type: ExecutorType
     endpoint: str
+    batch_window: float
+    max_batch_size: int
+    slots: int
+    breaker: CircuitBreaker
+    queue: RequestQueue
+    '''Shared queue of executor type'''
+    inbox: RequestQueue
+    '''Requests dispatched to this executor, None when slots pull from shared queue'''
+    busy: int
+    in_flight_work: float
+    client: httpx.AsyncClient
+    '''Generation traffic, created on start'''
+    control_client: httpx.AsyncClient
+    '''Pings and interrupts, never wait for a busy generation pool'''
 
     alive: bool = False
 
     save_images_locally = int(getenv('SAVE_IMAGES_LOCALLY'))
-    images_path = getenv('IMAGES_PATH')
     image_get_url = getenv('S3_IMAGE_ENDPOINT')
 
+    failure_threshold = int(getenv('BREAKER_FAILURE_THRESHOLD', 3))
+    health_interval = float(getenv('HEALTH_INTERVAL', 30))
+    probe_backoff_min = float(getenv('PROBE_BACKOFF_MIN', 1))
+    probe_backoff_max = float(getenv('PROBE_BACKOFF_MAX', 60))
+    request_retries = int(getenv('REQUEST_RETRIES', 2))
+
+    max_connections = int(getenv('HTTP_MAX_CONNECTIONS', 10))
+    max_keepalive = int(getenv('HTTP_MAX_KEEPALIVE', 10))
+    keepalive_expiry = float(getenv('HTTP_KEEPALIVE_EXPIRY', 30))
+    http2 = bool(int(getenv('HTTP2', 0)))
+    connect_timeout = float(getenv('HTTP_CONNECT_TIMEOUT', 5))
+    write_timeout = float(getenv('HTTP_WRITE_TIMEOUT', 30))
+
     def __init__(
             self,
             name: str,
@@ -30,7 +70,10 @@ class AbstractExecutor:
             gpu: str,
             timeout: float,
             model: str,
-            endpoint: str
+            endpoint: str,
+            batch_window: float = 0,
+            max_batch_size: int = 1,
+            slots: int = 1
         ) -> None:
         self.name = name
         self.exec_type = executor_type
@@ -38,6 +81,67 @@ class AbstractExecutor:
         self.timeout = timeout
         self.model = model
         self.endpoint = endpoint
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.slots = slots
+        self.breaker = CircuitBreaker(name, self.failure_threshold, self.on_breaker_change)
+        self.queue = None
+        self.inbox = None
+        self.busy = 0
+        self.in_flight_work = 0
+        self.notify = lambda: None
+        self.client = None
+        self.control_client = None
+
+    def open_clients(self) -> None:
+        '''Creates connection pools of this executor'''
+        http2 = self.http2
+        if http2 and importlib.util.find_spec('h2') is None:
+            logging.warning(f'`h2` is not installed, {self.name} uses HTTP/1.1')
+            http2 = False
+        self.client = httpx.AsyncClient(http2=http2, timeout=self.request_timeout(self.timeout),\
+            limits=httpx.Limits(max_connections=self.max_connections,\
+                max_keepalive_connections=self.max_keepalive, keepalive_expiry=self.keepalive_expiry))
+        self.control_client = httpx.AsyncClient(http2=http2, timeout=self.request_timeout(5),\
+            limits=httpx.Limits(max_connections=1, max_keepalive_connections=1,\
+                keepalive_expiry=self.keepalive_expiry))
+
+    async def close_clients(self) -> None:
+        for client in (self.client, self.control_client):
+            if client is not None:
+                await client.aclose()
+        self.client = None
+        self.control_client = None
+
+    def request_timeout(self, read: float) -> httpx.Timeout:
+        '''Read timeout is generation time, connecting and sending should be quick'''
+        return httpx.Timeout(read, connect=self.connect_timeout, write=self.write_timeout,\
+            pool=self.connect_timeout)
+
+    async def post_for_content(self, url: str, payload: dict, timeout: float, headers: dict = None) -> bytearray:
+        '''Sends api request, response body is read into one preallocated buffer'''
+        async with self.client.stream('POST', url, json=payload, headers=headers,\
+                timeout=self.request_timeout(timeout)) as response:
+            if response.status_code != 200:
+                await response.aread()
+                self.check_response(response)
+            length = response.headers.get('content-length')
+            content = bytearray()
+            if length is not None and response.headers.get('content-encoding') is None:
+                # Size is known, no reallocation while chunks arrive
+                content = bytearray(int(length))
+                view = memoryview(content)
+                position = 0
+                async for chunk in response.aiter_raw():
+                    view[position:position + len(chunk)] = chunk
+                    position += len(chunk)
+                view.release()
+                if position != len(content):
+                    raise Exception(f'`{self.name}` sent {position} of {len(content)} bytes')
+                return content
+            async for chunk in response.aiter_bytes():
+                content += chunk
+            return content
 
     async def ping(self) -> bool:
         raise NotImplementedError('Implement `ping` before using the executor')
@@ -50,58 +154,237 @@ class AbstractExecutor:
     
     async def img2img(self, request: GenerationRequest):
         raise NotImplementedError('`img2img` not implemented')
+
+    async def text2img_batch(self, requests: List[GenerationRequest]):
+        raise NotImplementedError('`text2img_batch` not implemented')
+
+    async def interrupt(self) -> None:
+        '''Stops the job running on backend, if backend supports it'''
+
+    def check_response(self, response) -> None:
+        '''Raises on unsuccessful backend response, body must be read'''
+        if response.status_code == 200:
+            return
+        message = f'`{self.name}` responded {response.status_code}: {response.text[:200]}'
+        if 400 <= response.status_code < 500:
+            raise BackendRequestError(message)
+        raise Exception(message)
+
+    async def collect_batch(
+            self,
+            request: GenerationRequest,
+            queue: RequestQueue
+        ) -> List[GenerationRequest]:
+        '''Returns requests to generate in one backend call'''
+        return [request]
     
-    async def loop(self, queue: RequestQueue):
+    def on_breaker_change(self, state: BreakerState) -> None:
+        if state == BreakerState.OPEN:
+            self.drain_inbox()
+            if self.alive:
+                AvgTimeCalc.remove_executor(self)
+                self.alive = False
+                Metrics.executor_flaps.inc(self.name, self.exec_type.value, 'dead')
+                logging.info(f'`{self.name}` is sleeping!')
+        elif not self.alive:
+            AvgTimeCalc.add_executor(self)
+            self.alive = True
+            Metrics.executor_flaps.inc(self.name, self.exec_type.value, 'alive')
+            logging.info(f'`{self.name}` is now working!')
+        self.notify()
+
+    def drain_inbox(self) -> None:
+        '''Returns dispatched requests to the shared queue keeping their order'''
+        if self.inbox is None or self.queue is None:
+            return
+        requests = []
+        while True:
+            request = self.inbox.get_request_nowait()
+            if request is None:
+                break
+            requests.append(request)
+        for request in reversed(requests):
+            self.queue.put_back(request)
+
+    async def health_loop(self):
+        '''Pings executor in background, probes of open circuit back off with jitter'''
+        backoff = self.probe_backoff_min
         while True:
             try:
-                # Alive loop
-                if not self.alive:
-                    if await self.ping():
-                        AvgTimeCalc.add_executor(self)                            
-                        self.alive = True
-                        logging.info(f'`{self.name}` is now working!')
-                    else:
+                healthy = await self.ping()
+                if not healthy:
+                    if self.breaker.state == BreakerState.OPEN:
                         logging.debug(f'`{self.name}` is still sleeping!')
-                        await asyncio.sleep(15)
+                    self.breaker.set_state(BreakerState.OPEN)
+                    delay = backoff
+                    backoff = min(backoff * 2, self.probe_backoff_max)
+                    await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                    continue
+                if self.breaker.state == BreakerState.OPEN:
+                    self.breaker.half_open()
+                elif self.breaker.state == BreakerState.CLOSED:
+                    # Failed trials keep backing off until one succeeds
+                    backoff = self.probe_backoff_min
+                # Failed generation or trial opens the circuit, probing starts right away
+                if await self.wait_for_open(self.health_interval * random.uniform(0.5, 1.5)):
+                    await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+                    backoff = min(backoff * 2, self.probe_backoff_max)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'Error in health loop `{self.name}`\n[{type(e)}] {e}')
+                await asyncio.sleep(self.probe_backoff_max)
+
+    async def wait_for_open(self, timeout: float) -> bool:
+        '''Waits up to `timeout` seconds, True as soon as the circuit opens'''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.breaker.state != BreakerState.OPEN:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.breaker.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def retry_or_fail(
+            self,
+            request: GenerationRequest,
+            queue: RequestQueue,
+            error: Exception,
+            retry: bool = True
+        ) -> None:
+        '''Returns failed request to the head of the queue while retries last'''
+        if request.cancelled:
+            queue.complete(request)
+            return
+        if retry and request.retries < self.request_retries:
+            request.retries += 1
+            logging.info(f'Requeueing request:{str(request.object_id)} '
+                f'({request.retries}/{self.request_retries})')
+            async with request.lock:
+                queue.put_back(request)
+                await request.set_queued(queue.work)
+                await request.send_to_client()
+            return
+        queue.complete(request)
+        Metrics.errors.inc(*Metrics.request_labels(request), 'generation')
+        async with request.lock:
+            await request.set_error(f'[{type(error)}] {error}')
+            await request.send_to_client()
+
+    async def loop(self, queue: RequestQueue):
+        self.queue = queue
+        while True:
+            try:
+                # Waiting for executor to be healthy
+                trial = await self.breaker.acquire()
+
+                # Waiting for request in inbox or shared queue
+                source = queue if self.inbox is None else self.inbox
+                request = await source.get_request()
+                if not self.breaker.check(trial):
+                    # Circuit opened while waiting
+                    queue.put_back(request)
+                    self.notify()
                     continue
 
-                # Waiting for request in queue
-                request = await queue.get_request()
-                if request is None:
-                    await asyncio.sleep(0.1)
+                requests = await self.collect_batch(request, source)
+                # Cancelled after being taken from queue
+                for request in requests:
+                    if request.cancelled:
+                        queue.complete(request)
+                requests = [request for request in requests if not request.cancelled]
+                if not requests:
+                    self.breaker.release_trial(trial)
+                    self.notify()
                     continue
+                work = sum(request.work for request in requests)
+                self.busy += 1
+                self.in_flight_work += work
+                self.notify()
 
-                # Generating new request
-                async with request.lock:
-                    await request.set_generating()
-                    await request.send_to_client()
-                    logging.info(f'{self.name} processing request:{str(request.object_id)}')
                 try:
-                    if request.gen_type == GenType.TEXT2IMG:
-                        await self.text2img(request)
-                    elif request.gen_type == GenType.IMG2IMG:
-                        await self.img2img(request)
-                    elif request.gen_type == GenType.MIX2IMG:
-                        await self.mix2img(request)
-                    # logging.info(f'{self.name} processed request:{str(request.object_id)}')
-                except Exception as e:
-                    logging.error(f'Error while {request.gen_type.value} {str(request.object_id)}\n[{type(e)}] {e}')
-                    AvgTimeCalc.remove_executor(self)
-                    self.alive = False
-                    logging.info(f'`{self.name}` is sleeping!')
-                    async with request.lock:
-                        await request.set_error(f'[{type(e)}] {e}')
-                        await request.send_to_client()
+                    # Generating new request
+                    for request in requests:
+                        request.executor_name = self.name
+                        Metrics.queue_wait.observe(perf_counter() - request.queued_at,\
+                            *Metrics.request_labels(request))
+                        async with request.lock:
+                            await request.set_generating()
+                            await request.send_to_client()
+                            logging.info(f'{self.name} processing request:{str(request.object_id)}')
+                    try:
+                        if await self.run_generation(requests):
+                            self.breaker.record_success()
+                        else:
+                            logging.info(f'{self.name} cancelled request:{str(request.object_id)}')
+                            self.breaker.release_trial(trial)
+                        for request in requests:
+                            queue.complete(request)
+                        # logging.info(f'{self.name} processed request:{str(request.object_id)}')
+                    except BackendRequestError as e:
+                        # Backend works, request itself is invalid
+                        logging.error(f'Backend rejected {request.gen_type.value} {str(request.object_id)}\n{e}')
+                        self.breaker.record_success()
+                        for request in requests:
+                            await self.retry_or_fail(request, queue, e, retry=False)
+                    except Exception as e:
+                        logging.error(f'Error while {request.gen_type.value} {str(request.object_id)}\n[{type(e)}] {e}')
+                        self.breaker.record_failure()
+                        # Put back to the head in reverse, batch keeps its order
+                        for request in reversed(requests):
+                            await self.retry_or_fail(request, queue, e)
+                finally:
+                    self.busy -= 1
+                    self.in_flight_work -= work
+                    self.notify()
             except Exception as e:
                 logging.error(f'Error in executor loop `{self.name}`\n[{type(e)}] {e}')
 
+    async def generate(self, requests: List[GenerationRequest]) -> None:
+        request = requests[0]
+        if len(requests) > 1:
+            await self.text2img_batch(requests)
+        elif request.gen_type == GenType.TEXT2IMG:
+            await self.text2img(request)
+        elif request.gen_type == GenType.IMG2IMG:
+            await self.img2img(request)
+        elif request.gen_type == GenType.MIX2IMG:
+            await self.mix2img(request)
+
+    async def run_generation(self, requests: List[GenerationRequest]) -> bool:
+        '''Runs backend call as a task cancel can stop, False if it was cancelled.
+
+        Only single requests own the task, cancelled requests of a batch just
+        drop their results.
+        '''
+        task = asyncio.get_running_loop().create_task(self.generate(requests))
+        if len(requests) == 1:
+            requests[0].task = task
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            requests[0].task = None
+        if task.cancelled():
+            # Backend works one job at a time, the running one may belong to another slot
+            if self.busy == 1:
+                await self.interrupt()
+            return False
+        task.result()
+        return True
+
     def save_locally(
             self,
             image_bytes,
             file_name
         ) -> None:
-        with open(file_name, 'wb') as f:
-            f.write(image_bytes)
+        ImageStore.put(image_bytes, file_name)
 
     async def save_to_s3_with_event(
             self,
@@ -109,31 +392,129 @@ class AbstractExecutor:
             images_bytes,
             file_name
         ) -> None:
+        if request.cancelled:
+            return
+        if request.delivery != 'url':
+            await self.deliver_inline(request, images_bytes, file_name)
+            return
         try:
-            image_url = await self.save_to_s3(images_bytes, file_name, True)
+            image_url, file_name, variants = await self.save_to_s3(request, images_bytes, file_name)
             async with request.lock:
-                await request.set_ok(ContentType.IMAGE_URL, image_url, file_name)
+                # Cancelled while uploading, client already has the cancelled state
+                if request.cancelled:
+                    return
+                await request.set_ok(ContentType.IMAGE_URL, image_url, file_name, variants)
+            ResultCache.put(request, image_url, file_name, variants)
         except Exception as e:
             logging.error(f'Error while saving image {str(request.object_id)}\n[{type(e)}] {e}')
+            Metrics.errors.inc(*Metrics.request_labels(request), 'upload')
             async with request.lock:
-                await request.set_error(f'[{type(e)}] {e}')
+                if not request.cancelled:
+                    await request.set_error(f'[{type(e)}] {e}')
         finally:
+            if not request.cancelled:
+                # Failed uploads are not completed requests
+                if request.gen_status == GenStatus.OK:
+                    Metrics.latency.observe(perf_counter() - request.queued_at,\
+                        *Metrics.request_labels(request))
+                async with request.lock:
+                    await request.send_to_client()
+                logging.info(f'{self.name} processed request:{str(request.object_id)}')
+
+    async def deliver_inline(
+            self,
+            request,
+            image_bytes,
+            file_name
+        ) -> None:
+        '''Sends image over websocket right away, S3 upload (if any) follows'''
+        labels = Metrics.request_labels(request)
+        try:
+            images = await self.encode(request, image_bytes, file_name)
+            _, file_name, _, image_bytes = images[0]
             async with request.lock:
-                await request.send_to_client()
-            logging.info(f'{self.name} processed request:{str(request.object_id)}')
+                # Cancelled while encoding
+                if request.cancelled:
+                    return
+                # Url replaces the inline result once the image is uploaded
+                await request.set_ok(ContentType(request.delivery), None, file_name)
+                await request.send_image(image_bytes)
+        except Exception as e:
+            logging.error(f'Error while sending image {str(request.object_id)}\n[{type(e)}] {e}')
+            Metrics.errors.inc(*labels, 'delivery')
+            async with request.lock:
+                if not request.cancelled:
+                    await request.set_error(f'[{type(e)}] {e}')
+                    await request.send_to_client()
+            return
+        Metrics.latency.observe(perf_counter() - request.queued_at, *labels)
+        logging.info(f'{self.name} processed request:{str(request.object_id)}')
+
+        if not request.upload:
+            return
+        try:
+            variants = await self.upload_images(images, labels)
+            image_url = f'{self.image_get_url}{file_name}'
+            async with request.lock:
+                request.result_type = ContentType.IMAGE_URL
+                request.result = image_url
+                request.variants = variants or None
+                request.save()
+            ResultCache.put(request, image_url, file_name, variants)
+        except Exception as e:
+            # Client already has the image
+            logging.error(f'Error while saving image {str(request.object_id)}\n[{type(e)}] {e}')
+            Metrics.errors.inc(*labels, 'upload')
+
+    async def encode(
+            self,
+            request,
+            image_bytes,
+            file_name
+        ) -> List[Tuple[Union[str, None], str, str, bytes]]:
+        '''Encodes image and its variants in parallel, (variant, file name, content type, bytes)'''
+        outputs = OutputEncoding.outputs(OutputEncoding.resolve(request), file_name)
+        time_start = perf_counter()
+        encoded = await ImageCompressor.encode(image_bytes, [options for _, _, options in outputs])
+        Metrics.compression.observe(perf_counter() - time_start, *Metrics.request_labels(request))
+        images = [(name, file_name, OutputEncoding.content_type(options), data)\
+            for (name, file_name, options), data in zip(outputs, encoded)]
+        if self.save_images_locally:
+            for _, file_name, _, data in images:
+                self.save_locally(data, file_name)
+        return images
+
+    async def upload_images(
+            self,
+            images,
+            labels
+        ) -> Dict[str, str]:
+        '''Uploads encoded images concurrently, returns urls of variants'''
+        await asyncio.gather(*[self.upload_to_s3(data, file_name, labels, content_type)\
+            for _, file_name, content_type, data in images])
+        return {name: f'{self.image_get_url}{file_name}' for name, file_name, _, _ in images if name is not None}
 
     async def save_to_s3(
             self, 
+            request,
             image_bytes, 
-            file_name, 
-            sync = False
-        ) -> str:
-        '''returns image url'''
-        if sync:
-            await Storage.upload_image_bytes(image_bytes, file_name)
-        else:
-            loop = asyncio.get_running_loop()
-            loop.create_task(Storage.upload_image_bytes(image_bytes, file_name))
-        return f'{self.image_get_url}{file_name}'
-
-    
\ No newline at end of file
+            file_name
+        ) -> Tuple[str, str, Dict[str, str]]:
+        '''returns image url, its file name and urls of variants'''
+        images = await self.encode(request, image_bytes, file_name)
+        variants = await self.upload_images(images, Metrics.request_labels(request))
+        file_name = images[0][1]
+        return f'{self.image_get_url}{file_name}', file_name, variants
+
+    async def upload_to_s3(
+            self,
+            image_bytes,
+            file_name,
+            labels,
+            content_type = 'image/jpeg'
+        ) -> None:
+        time_start = perf_counter()
+        uploaded = await Storage.upload_image_bytes(image_bytes, file_name, content_type)
+        Metrics.upload.observe(perf_counter() - time_start, *labels)
+        if not uploaded:
+            raise Exception(f'Cannot save image {file_name} to S3 storage')
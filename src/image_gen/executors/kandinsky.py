@@ -1,4 +1,3 @@
-import httpx
 import logging
 import asyncio
 
@@ -11,8 +10,6 @@ from ..request import GenerationRequest
 
 from ..avg_time import AvgTimeCalc
 
-client = httpx.AsyncClient()
-
 class KandinskyExecutor(AbstractExecutor):
     def __init__(
             self, 
@@ -21,13 +18,17 @@ class KandinskyExecutor(AbstractExecutor):
             gpu: str, 
             timeout: float, 
             model: str, 
-            endpoint: str
+            endpoint: str,
+            batch_window: float = 0,
+            max_batch_size: int = 1,
+            slots: int = 1
         ) -> None:
-        super().__init__(name, executor_type, gpu, timeout, model, endpoint)
+        super().__init__(name, executor_type, gpu, timeout, model, endpoint,\
+            batch_window, max_batch_size, slots)
 
     async def ping(self):
         try:
-            response = await client.get(url=self.endpoint, timeout=2, \
+            response = await self.control_client.get(url=self.endpoint, timeout=2, \
                 headers={'authorization': getenv('KANDINSKY_API_TOKEN'), 'ngrok-skip-browser-warning': '1'})
             if response.content == b'{"RestAPI":"Kandinskiy 2.1 Model","website":"https://web.devoid.pics/"}':
                 return True
@@ -40,18 +41,12 @@ class KandinskyExecutor(AbstractExecutor):
     async def text2img(self, request: GenerationRequest):
         # Sending api request
         payload = request.payload
-        response = await client.post(url=f'{self.endpoint}/text2img',\
-            json=payload, timeout=self.timeout, follow_redirects=True,\
+        image_bytes = await self.post_for_content(f'{self.endpoint}/text2img', payload, self.timeout,\
             headers={'authorization': getenv('KANDINSKY_API_TOKEN'), 'ngrok-skip-browser-warning': '1'})
         
         # Getting result
-        image_bytes = response.content
         file_name = f'{str(request.object_id)}.jpg'
 
-        # Saving locally if needed
-        if self.save_images_locally:
-            self.save_locally(image_bytes, file_name)
-
         loop = asyncio.get_event_loop()
         loop.create_task(self.save_to_s3_with_event(request, image_bytes, file_name))
 
@@ -66,18 +61,12 @@ class KandinskyExecutor(AbstractExecutor):
     async def img2img(self, request: GenerationRequest):
         # Sending api request
         payload = request.payload
-        response = await client.post(url=f'{self.endpoint}/img2img',\
-            json=payload, timeout=self.timeout, follow_redirects=True,\
+        image_bytes = await self.post_for_content(f'{self.endpoint}/img2img', payload, self.timeout,\
             headers={'authorization': getenv('KANDINSKY_API_TOKEN'), 'ngrok-skip-browser-warning': '1'})
         
         # Getting result
-        image_bytes = response.content
         file_name = f'{str(request.object_id)}.jpg'
 
-        # Saving locally if needed
-        if self.save_images_locally:
-            self.save_locally(image_bytes, file_name)
-
         loop = asyncio.get_event_loop()
         loop.create_task(self.save_to_s3_with_event(request, image_bytes, file_name))
 
@@ -92,18 +81,12 @@ class KandinskyExecutor(AbstractExecutor):
     async def mix2img(self, request: GenerationRequest):
         # Sending api request
         payload = request.payload
-        response = await client.post(url=f'{self.endpoint}/mix2images',\
-            json=payload, timeout=self.timeout, follow_redirects=True,\
+        image_bytes = await self.post_for_content(f'{self.endpoint}/mix2images', payload, self.timeout,\
             headers={'authorization': getenv('KANDINSKY_API_TOKEN'), 'ngrok-skip-browser-warning': '1'})
         
         # Getting result
-        image_bytes = response.content
         file_name = f'{str(request.object_id)}.jpg'
 
-        # Saving locally if needed
-        if self.save_images_locally:
-            self.save_locally(image_bytes, file_name)
-
         loop = asyncio.get_event_loop()
         loop.create_task(self.save_to_s3_with_event(request, image_bytes, file_name))
 
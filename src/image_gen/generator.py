@@ -1,41 +1,139 @@
+import weakref
 import logging 
 
-from typing import Tuple, Callable, List
+from typing import Tuple, Callable, List, Dict, Any, Union
 from collections.abc import Coroutine
 from asyncio import AbstractEventLoop
 
-from enums import ExecutorType
+from bson.objectid import ObjectId
+
+from enums import ExecutorType, Service, GenStatus
+from utils.database import DevoidDatabase
 
 from .queue import RequestQueue
+from .mongo_queue import MongoRequestQueue
+from .scheduler import AbstractScheduler, RatioScheduler, FairScheduler
 from .executors.automatic1111 import Automatic1111Executor
 from .executors.kandinsky import KandinskyExecutor
 from .executors.executor import AbstractExecutor
 from .request import GenerationRequest
+from .dispatcher import Dispatcher
 
 class ImageGenerator():
     loop: AbstractEventLoop
     executors: List[AbstractExecutor]
 
-    automatic1111_queue: RequestQueue
-    kandinsky_queue: RequestQueue
+    automatic1111_queue: Union[RequestQueue, MongoRequestQueue]
+    kandinsky_queue: Union[RequestQueue, MongoRequestQueue]
+    dispatch: str
+    dispatch_depth: int
+    requests: weakref.WeakValueDictionary
+    '''Unfinished requests of this process by object_id'''
     
     def __init__(
             self, 
-            ratio: Tuple[int, int]
+            ratio: Tuple[int, int],
+            scheduler: str = 'ratio',
+            service_weights: Dict[Service, float] = None,
+            user_weights: Dict[Tuple[Service, Any], float] = None,
+            dispatch: str = 'pull',
+            dispatch_depth: int = 1,
+            backend: str = 'memory'
         ) -> None:
+        if dispatch not in ('pull', 'lect'):
+            raise ValueError(f'Unknown dispatch strategy `{dispatch}`')
         self.loop = None
         self.executors = list()
+        self.ws_handler = None
+        self.dispatch = dispatch
+        self.dispatch_depth = dispatch_depth
+        self.requests = weakref.WeakValueDictionary()
+
+        if backend == 'memory':
+            self.automatic1111_queue = RequestQueue(ratio,\
+                self.create_scheduler(scheduler, ratio, service_weights, user_weights))
+            self.kandinsky_queue = RequestQueue(ratio,\
+                self.create_scheduler(scheduler, ratio, service_weights, user_weights))
+        elif backend == 'mongo':
+            # Scheduler is replaced by ratio claims from the shared queue
+            self.automatic1111_queue = MongoRequestQueue(ExecutorType.AUTOMATIC1111, ratio)
+            self.kandinsky_queue = MongoRequestQueue(ExecutorType.KANDINSKY, ratio)
+        else:
+            raise ValueError(f'Unknown queue backend `{backend}`')
+
+    @staticmethod
+    def create_scheduler(
+            scheduler: str,
+            ratio: Tuple[int, int],
+            service_weights: Dict[Service, float] = None,
+            user_weights: Dict[Tuple[Service, Any], float] = None
+        ) -> AbstractScheduler:
+        if scheduler == 'ratio':
+            return RatioScheduler(ratio)
+        elif scheduler == 'fair':
+            return FairScheduler(ratio, service_weights, user_weights)
+        raise ValueError(f'Unknown queue scheduler `{scheduler}`')
 
-        self.automatic1111_queue = RequestQueue(ratio)
-        self.kandinsky_queue = RequestQueue(ratio)
+    @property
+    def distributed(self) -> bool:
+        '''Queue is shared, executors may run in other processes'''
+        return isinstance(self.automatic1111_queue, MongoRequestQueue)
+
+    def set_ws_handler(self, ws_handler: Coroutine) -> None:
+        '''Sender for requests claimed from the shared queue'''
+        for queue in (self.automatic1111_queue, self.kandinsky_queue):
+            if isinstance(queue, MongoRequestQueue):
+                queue.ws_handler = ws_handler
+        self.ws_handler = ws_handler
+
+    async def recover(self) -> int:
+        '''Requeues requests left unfinished by previous run, returns their count'''
+        if self.distributed:
+            # Shared queue keeps requests itself
+            return 0
+        count = 0
+        async for document in DevoidDatabase.find_unfinished_requests():
+            try:
+                request = GenerationRequest.restore(document, self.ws_handler)
+            except Exception as e:
+                logging.error(f'Cannot restore request {document.get("_id")}: {e}')
+                continue
+            if request.executor == ExecutorType.AUTOMATIC1111:
+                self.add_automatic1111_request(request)
+            elif request.executor == ExecutorType.KANDINSKY:
+                self.add_kandinsky_request(request)
+            if document.get('gen_status') != GenStatus.QUEUED.value:
+                await request.set_queued(0)
+            count += 1
+        if count:
+            logging.info(f'Recovered {count} unfinished requests')
+        return count
 
     def start(self, loop: AbstractEventLoop):
         self.loop = loop
+        self.automatic1111_queue.start(loop)
+        self.kandinsky_queue.start(loop)
+        if self.dispatch == 'lect':
+            # Executors take requests from their inboxes filled by dispatchers
+            for executor_class, queue in ((Automatic1111Executor, self.automatic1111_queue),\
+                    (KandinskyExecutor, self.kandinsky_queue)):
+                executors = [executor for executor in self.executors if isinstance(executor, executor_class)]
+                if executors:
+                    loop.create_task(Dispatcher(queue, executors, self.dispatch_depth).loop())
+        for executor in self.executors:
+            executor.open_clients()
+            loop.create_task(executor.health_loop())
+            # One worker per slot
+            for _ in range(executor.slots):
+                if isinstance(executor, Automatic1111Executor):
+                    loop.create_task(executor.loop(self.automatic1111_queue))
+                if isinstance(executor, KandinskyExecutor):
+                    loop.create_task(executor.loop(self.kandinsky_queue))
+
+    async def close(self) -> None:
+        '''Closes connection pools of executors'''
         for executor in self.executors:
-            if isinstance(executor, Automatic1111Executor):
-                loop.create_task(executor.loop(self.automatic1111_queue))
-            if isinstance(executor, KandinskyExecutor):
-                loop.create_task(executor.loop(self.kandinsky_queue))
+            await executor.close_clients()
 
     def add_executor(
             self, 
@@ -44,16 +142,70 @@ class ImageGenerator():
             endpoint: str, 
             gpu: str, 
             timeout: float = 20, 
-            model = None
+            model = None,
+            batch_window: float = 0,
+            max_batch_size: int = 1,
+            slots: int = 1
         ) -> None:
         if executor_type == ExecutorType.AUTOMATIC1111:
-            executor = Automatic1111Executor(name, executor_type, gpu, timeout, model, endpoint)
+            executor = Automatic1111Executor(name, executor_type, gpu, timeout, model, endpoint,\
+                batch_window, max_batch_size, slots)
         elif executor_type == ExecutorType.KANDINSKY:
-            executor = KandinskyExecutor(name, executor_type, gpu, timeout, model, endpoint)
+            executor = KandinskyExecutor(name, executor_type, gpu, timeout, model, endpoint,\
+                batch_window, max_batch_size, slots)
         self.executors.append(executor)
 
+    def get_queue(self, executor_type: ExecutorType) -> Union[RequestQueue, MongoRequestQueue]:
+        if executor_type == ExecutorType.AUTOMATIC1111:
+            return self.automatic1111_queue
+        return self.kandinsky_queue
+
+    def queued_work(self, executor_type: ExecutorType) -> float:
+        '''Work waiting in shared queue and executor inboxes'''
+        return self.get_queue(executor_type).work + sum(executor.inbox.work for executor in self.executors\
+            if executor.exec_type == executor_type and executor.inbox is not None)
+
+    async def cancel(self, object_id: str, service: Service, reason: str = 'Request cancelled') -> bool:
+        '''Cancels queued or generating request of service, False if it is unknown, already done or not its own'''
+        try:
+            object_id = ObjectId(object_id)
+        except Exception:
+            return False
+        # Claimed copy has the current state, accepted one may be stale
+        request = None
+        for queue in (self.automatic1111_queue, self.kandinsky_queue):
+            if isinstance(queue, MongoRequestQueue):
+                request = queue.leased.get(object_id)
+                if request is not None:
+                    break
+        if request is None:
+            request = self.requests.get(object_id)
+        if request is not None:
+            if request.service != service:
+                return False
+            return await request.cancel(reason)
+        if self.distributed:
+            # Request is held by another process, its heartbeat picks the flag up
+            return await self.automatic1111_queue.cancel_id(object_id, service)\
+                or await self.kandinsky_queue.cancel_id(object_id, service)
+        return False
+
+    def schedule_deadline(self, request: GenerationRequest) -> None:
+        '''Cancels request still unfinished after `settings.deadline` seconds'''
+        deadline = request.deadline
+        if not deadline:
+            return
+        # Timer must not keep finished request alive
+        self.loop.call_later(deadline, self.expire_deadline, weakref.ref(request), deadline)
+
+    def expire_deadline(self, ref: weakref.ref, deadline: float) -> None:
+        request = ref()
+        if request is not None and not request.cancelled:
+            self.loop.create_task(request.cancel(f'Deadline of {deadline:g}s exceeded'))
+
     def add_automatic1111_request(self, request: GenerationRequest):
         logging.debug(f'Adding request to automatic1111 queue')
+        self.requests[request.object_id] = request
         if request.premium:
             self.automatic1111_queue.put_premium(request)
         else:
@@ -61,6 +213,7 @@ class ImageGenerator():
             
     def add_kandinsky_request(self, request: GenerationRequest):
         logging.debug(f'Adding request to kandinsky queue')
+        self.requests[request.object_id] = request
         if request.premium:
             self.kandinsky_queue.put_premium(request)
         else:
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+
+from enum import Enum
+from typing import Callable
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+class CircuitBreaker():
+    '''Per executor circuit breaker.
+
+    CLOSED lets every slot take requests, OPEN lets none. Health probes move
+    OPEN to HALF_OPEN, where a single trial request decides between CLOSED and OPEN.
+    '''
+    name: str
+    state: BreakerState
+    failures: int
+    failure_threshold: int
+    trial: bool
+    changed: asyncio.Event
+
+    def __init__(
+            self,
+            name: str,
+            failure_threshold: int,
+            on_change: Callable[[BreakerState], None]
+        ) -> None:
+        self.name = name
+        self.state = BreakerState.OPEN
+        self.failures = 0
+        self.failure_threshold = failure_threshold
+        self.trial = False
+        self.on_change = on_change
+        self.changed = asyncio.Event()
+
+    def set_state(self, state: BreakerState) -> None:
+        if state == self.state:
+            return
+        logging.info(f'`{self.name}` circuit {self.state.value} -> {state.value}')
+        self.state = state
+        self.trial = False
+        self.on_change(state)
+        # Waking everyone waiting for a change
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def acquire(self) -> bool:
+        '''Waits until a request may be taken, returns True for half-open trial'''
+        while True:
+            if self.state == BreakerState.CLOSED:
+                return False
+            if self.state == BreakerState.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            await self.changed.wait()
+
+    def check(self, trial: bool) -> bool:
+        '''Whether taken request may still be generated'''
+        if self.state != BreakerState.OPEN:
+            return True
+        if trial:
+            self.trial = False
+        return False
+
+    def release_trial(self, trial: bool) -> None:
+        '''Half-open trial ended without result, another request may try'''
+        if trial and self.trial:
+            self.trial = False
+            if self.state == BreakerState.HALF_OPEN:
+                # Waking slots waiting for the trial
+                changed, self.changed = self.changed, asyncio.Event()
+                changed.set()
+
+    def half_open(self) -> None:
+        if self.state == BreakerState.OPEN:
+            self.failures = 0
+            self.set_state(BreakerState.HALF_OPEN)
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.trial = False
+        self.set_state(BreakerState.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial = False
+        if self.state == BreakerState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.set_state(BreakerState.OPEN)
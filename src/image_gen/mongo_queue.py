@@ -0,0 +1,347 @@
+import os
+import socket
+import datetime
+import asyncio
+import logging
+
+from uuid import uuid4
+from time import time, perf_counter
+from functools import partial
+from typing import Tuple, Union, Dict
+from collections.abc import Coroutine
+from bson.objectid import ObjectId
+
+from enums import *
+from utils.database import DevoidDatabase
+from utils.json_codec import dumps, loads
+
+from .request import GenerationRequest
+from .admission import AdmissionControl
+
+class MongoRequestQueue():
+    '''Request queue shared by generator processes through MongoDB.
+
+    Requests are claimed with atomic `find_one_and_update` leases. Claimed
+    requests are kept alive by heartbeats, requests of a crashed process are
+    claimed again once their lease expires. General and premium requests are
+    served by `ratio` within each process.
+
+    State of a request claimed by another process goes back through the
+    `queue_messages` collection to the process that accepted it, the client
+    is connected there.
+    '''
+    exec_type: ExecutorType
+    ratio: Tuple[int, int]
+    owner: str
+    '''Unique id of this process, also the gateway id of requests it accepts'''
+    leased: Dict[ObjectId, GenerationRequest]
+    '''Requests claimed by this process'''
+    ws_handler: Coroutine
+    work: float
+    '''Predicted work of queued requests, refreshed with heartbeats'''
+    remote: bool = True
+    '''Queued requests are copies, process claiming one changes its state'''
+
+    lease = float(os.getenv('QUEUE_LEASE', 30))
+    poll_interval = float(os.getenv('QUEUE_POLL_INTERVAL', 0.5))
+
+    def __init__(
+            self,
+            exec_type: ExecutorType,
+            ratio: Tuple[int, int]
+        ) -> None:
+        self.exec_type = exec_type
+        self.ratio = ratio
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+        self.leased = {}
+        self.ws_handler = None
+        self.changed = asyncio.Event()
+
+        self.work = 0.0
+        self.sizes = {False: 0, True: 0}
+        self.service_sizes = {}
+        self.cur_general_count = 0
+        self.cur_premium_count = 0
+        self.heartbeat = None
+        self.relay = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.heartbeat = loop.create_task(self.heartbeat_loop())
+        self.relay = loop.create_task(self.relay_loop())
+
+    async def relay_loop(self) -> None:
+        '''Sends state of accepted requests produced by other processes'''
+        while True:
+            try:
+                document = await DevoidDatabase.take_relayed_message(self.owner)
+                if document is not None:
+                    await self.send_message(Service(document['service']), document['message'],\
+                        document.get('data'), document.get('labels'))
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'Error in queue relay `{self.exec_type.value}`\n[{type(e)}] {e}')
+            await asyncio.sleep(self.poll_interval)
+
+    async def heartbeat_loop(self) -> None:
+        '''Renews leases of claimed requests and refreshes queue stats'''
+        while True:
+            try:
+                if self.leased:
+                    ids = list(self.leased.keys())
+                    await DevoidDatabase.renew_leases(ids, self.owner, self.lease)
+                    # Cancelled through another process
+                    for id in await DevoidDatabase.find_cancelled_requests(ids, self.owner):
+                        request = self.leased.get(id)
+                        if request is not None:
+                            await request.cancel()
+                stats = await DevoidDatabase.queue_stats(self.exec_type.value)
+                sizes = {False: 0, True: 0}
+                service_sizes = {}
+                for (premium, service), (count, _) in stats.items():
+                    sizes[premium] += count
+                    service = Service(service)
+                    service_sizes[service] = service_sizes.get(service, 0) + count
+                self.sizes = sizes
+                self.service_sizes = service_sizes
+                self.work = sum(work for _, work in stats.values())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'Error in queue heartbeat `{self.exec_type.value}`\n[{type(e)}] {e}')
+            await asyncio.sleep(self.lease / 3)
+
+    def tier_order(self) -> Tuple[bool, bool]:
+        '''Premium flags in the order they are tried, same turns as `RatioScheduler`'''
+        if self.cur_general_count >= self.ratio[0] and \
+                self.cur_premium_count >= self.ratio[1]:
+            self.cur_general_count = 0
+            self.cur_premium_count = 0
+        if self.cur_general_count < self.ratio[0]:
+            self.cur_general_count += 1
+            return (False, True)
+        self.cur_premium_count += 1
+        return (True, False)
+
+    async def claim(self) -> Union[GenerationRequest, None]:
+        for premium in self.tier_order():
+            while True:
+                document = await DevoidDatabase.claim_request(self.exec_type.value,\
+                    premium, self.owner, self.lease)
+                if document is None:
+                    break
+                request = self.restore(document)
+                self.leased[request.object_id] = request
+                self.sizes[premium] = max(self.sizes[premium] - 1, 0)
+                self.count_service(request, -1)
+                self.work = max(self.work - request.work, 0.0)
+                if AdmissionControl.expired(request):
+                    asyncio.get_running_loop().create_task(AdmissionControl.expire(request, self))
+                    continue
+                return request
+        return None
+
+    def count_service(self, request: GenerationRequest, delta: int) -> None:
+        self.service_sizes[request.service] = max(self.service_sizes.get(request.service, 0) + delta, 0)
+
+    def get_service_size(self, service: Service) -> int:
+        return self.service_sizes.get(service, 0)
+
+    async def get_request(self, timeout: float = None) -> Union[GenerationRequest, None]:
+        '''Waits until a request is claimed and returns it, None on timeout'''
+        if timeout is not None:
+            try:
+                return await asyncio.wait_for(self.get_request(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+        while True:
+            self.changed.clear()
+            try:
+                request = await self.claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'Cannot claim request from queue\n[{type(e)}] {e}')
+                request = None
+            if request is not None:
+                return request
+            # Local puts wake up at once, other processes are polled
+            try:
+                await asyncio.wait_for(self.changed.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_request_nowait(self) -> None:
+        '''Claims need a database round trip, use `get_request`'''
+        return None
+
+    def document(self, request: GenerationRequest) -> dict:
+        return {
+            '_id': request.object_id,
+            'exec_type': self.exec_type.value,
+            'premium': bool(request.premium),
+            'status': 'queued',
+            'order': time(),
+            'owner': None,
+            'lease_until': None,
+            'gateway': self.owner,
+            'work': request.work,
+            'retries': request.retries,
+            'cache_key': request.cache_key,
+            'request': {
+                'service': request.service.value,
+                'message_type': MessageType.REQUEST.value,
+                'executor': request.executor.value,
+                'gen_type': request.gen_type.value,
+                'settings': request.settings,
+                'service_info': request.service_info,
+                'payload': request.payload
+            }
+        }
+
+    def restore(self, document: dict) -> GenerationRequest:
+        '''Rebuilds claimed request, it may come from another process'''
+        # Enqueuing process already saved the request
+        gateway = document.get('gateway')
+        if gateway is None or gateway == self.owner:
+            ws_handler = self.send_message
+        else:
+            ws_handler = partial(self.relay_message, gateway)
+        request = GenerationRequest.restore({'_id': document['_id'], **document['request']}, ws_handler)
+        request.retries = document.get('retries', 0)
+        request.cache_key = document.get('cache_key')
+        request.queued_at = perf_counter() - max(time() - document['order'], 0)
+        request.cancelled = document.get('cancelled', False)
+        return request
+
+    async def send_message(self, service: Service, json_message, data: bytes = None, labels: tuple = None) -> None:
+        '''Client of another process may not be connected here'''
+        try:
+            await self.ws_handler(service, json_message, data=data, labels=labels)
+        except Exception as e:
+            logging.warning(f'Cannot send request state to {service.name}: {e}')
+
+    async def relay_message(
+            self,
+            gateway: str,
+            service: Service,
+            json_message,
+            data: bytes = None,
+            labels: tuple = None
+        ) -> None:
+        try:
+            await DevoidDatabase.relay_message({
+                'gateway': gateway,
+                'service': service.value,
+                # Cached payload JSON is spliced in by the codec only
+                'message': loads(dumps(json_message)),
+                'data': data,
+                'labels': labels,
+                'created_date': datetime.datetime.utcnow()
+            })
+        except Exception as e:
+            logging.warning(f'Cannot relay request state to {service.name}: {e}')
+
+    async def insert(self, request: GenerationRequest) -> None:
+        try:
+            await DevoidDatabase.enqueue_request(self.document(request))
+            self.changed.set()
+        except Exception as e:
+            logging.error(f'Cannot enqueue request:{str(request.object_id)}\n[{type(e)}] {e}')
+            async with request.lock:
+                await request.set_error('Cannot enqueue request')
+                await request.send_to_client()
+
+    def cancel(self, request: GenerationRequest) -> None:
+        '''Request was removed from the shared queue by `cancel_request`'''
+        self.sizes[bool(request.premium)] = max(self.sizes[bool(request.premium)] - 1, 0)
+        self.count_service(request, -1)
+        self.work = max(self.work - request.work, 0.0)
+
+    async def cancel_request(self, request: GenerationRequest, reason: str) -> bool:
+        '''Cancels request accepted by this process.
+
+        Its copy is cancelled here only while nobody has claimed it, otherwise
+        the claiming process is flagged and sends the cancelled state itself.
+        '''
+        try:
+            if not await DevoidDatabase.remove_queued_request(request.object_id, request.service.value):
+                return await DevoidDatabase.flag_queued_request(request.object_id, request.service.value)
+        except Exception as e:
+            logging.error(f'Cannot cancel request:{str(request.object_id)}\n[{type(e)}] {e}')
+            return False
+        if request.queue is not self:
+            return False
+        self.cancel(request)
+        request.queue = None
+        return await request.cancel(reason)
+
+    async def cancel_id(self, id: ObjectId, service: Service) -> bool:
+        '''Cancels request of service by id in the shared queue, whichever process holds it'''
+        try:
+            return await DevoidDatabase.cancel_queued_request(id, service.value)
+        except Exception as e:
+            logging.error(f'Cannot cancel request:{str(id)}\n[{type(e)}] {e}')
+            return False
+
+    def put(self, request: GenerationRequest, premium: bool) -> None:
+        request.queued_at = perf_counter()
+        request.queue = self
+        self.sizes[premium] += 1
+        self.count_service(request, 1)
+        self.work += request.work
+        asyncio.get_running_loop().create_task(self.insert(request))
+
+    @property
+    def general_size(self) -> int:
+        return self.sizes[False]
+
+    @property
+    def premium_size(self) -> int:
+        return self.sizes[True]
+
+    def get_total_size(self) -> int:
+        return self.sizes[False] + self.sizes[True]
+
+    def put_general(self, request: GenerationRequest):
+        self.put(request, False)
+
+    def put_premium(self, request: GenerationRequest):
+        self.put(request, True)
+
+    async def release(self, request: GenerationRequest) -> None:
+        try:
+            await DevoidDatabase.release_request(request.object_id, self.owner, request.retries)
+            self.changed.set()
+        except Exception as e:
+            # Lease expires and request is claimed again
+            logging.error(f'Cannot release request:{str(request.object_id)}\n[{type(e)}] {e}')
+
+    def put_back(self, request: GenerationRequest):
+        '''Returns claimed request to the queue, its order is kept'''
+        self.leased.pop(request.object_id, None)
+        if request.cancelled:
+            self.complete(request)
+            return
+        self.sizes[bool(request.premium)] += 1
+        self.count_service(request, 1)
+        self.work += request.work
+        # Tier gets its turn back
+        if request.premium:
+            self.cur_premium_count = max(self.cur_premium_count - 1, 0)
+        else:
+            self.cur_general_count = max(self.cur_general_count - 1, 0)
+        asyncio.get_running_loop().create_task(self.release(request))
+
+    async def remove(self, request: GenerationRequest) -> None:
+        try:
+            await DevoidDatabase.complete_request(request.object_id, self.owner)
+        except Exception as e:
+            logging.error(f'Cannot remove request:{str(request.object_id)} from queue\n[{type(e)}] {e}')
+
+    def complete(self, request: GenerationRequest) -> None:
+        '''Drops processed request from the queue'''
+        self.leased.pop(request.object_id, None)
+        asyncio.get_running_loop().create_task(self.remove(request))
@@ -1,73 +1,172 @@
 import asyncio
 import logging
 
-from typing import Tuple
-from queue import Queue
+from time import perf_counter
+from collections import deque
+from typing import Tuple, Union, Deque, Dict
 
 from .request import GenerationRequest
+from .scheduler import AbstractScheduler, RatioScheduler
+from .admission import AdmissionControl
 
-from asyncio import Lock
+from enums import Service
+
+from asyncio import Future
 
 class RequestQueue():
-    general_size: int
-    premium_size: int
-    
-    general_queue: Queue
-    premium_queue: Queue
-    
-    lock: Lock
-    ratio: Tuple[int, int]
-    
-    def __init__(self, ratio: Tuple[int, int]) -> None:
-        self.general_size = 0
-        self.premium_size = 0
-        
-        self.general_queue = Queue()
-        self.premium_queue = Queue()
-        
-        self.ratio = ratio
-        
-        self.cur_general_count = 0
-        self.cur_premium_count = 0
-
-        self.lock = Lock()
-    
-    async def get_request(self):
-        async with self.lock:
-            if self.cur_general_count >= self.ratio[0] and \
-                    self.cur_premium_count >= self.ratio[1]:
-                self.cur_general_count = 0
-                self.cur_premium_count = 0
-
-            if self.cur_general_count < self.ratio[0]:
-                self.cur_general_count += 1
-                if self.general_size:
-                    return self.get_general()
-            if self.cur_premium_count < self.ratio[1]:
-                self.cur_premium_count += 1
-                if self.premium_size:
-                    return self.get_premium()
-        
-            return None
-    
+    scheduler: AbstractScheduler
+    getters: Deque[Future]
+    '''Executors waiting for requests, woken one per put instead of polling'''
+    work: float
+    '''Predicted work of queued requests'''
+    spill: bool
+    '''Whether large payloads of queued requests are moved to disk'''
+    service_sizes: Dict[Service, int]
+    tombstones: Dict[bool, int]
+    '''Cancelled requests still in scheduler by premium'''
+    remote: bool = False
+    '''Queued requests are the requests themselves, not copies'''
+
+    def __init__(
+            self,
+            ratio: Tuple[int, int],
+            scheduler: AbstractScheduler = None,
+            spill: bool = True
+        ) -> None:
+        if scheduler is None:
+            scheduler = RatioScheduler(ratio)
+        self.scheduler = scheduler
+        self.spill = spill
+
+        self.getters = deque()
+        self.work = 0.0
+        self.service_sizes = {}
+        self.tombstones = {False: 0, True: 0}
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        '''In-memory queue has no background tasks'''
+
+    def complete(self, request: GenerationRequest) -> None:
+        '''Taken requests are already gone from in-memory queue'''
+
+    def wakeup_next(self) -> None:
+        while self.getters:
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    async def get_request(self, timeout: float = None) -> Union[GenerationRequest, None]:
+        '''Waits until a request is queued and returns it, None on timeout'''
+        if timeout is not None:
+            try:
+                return await asyncio.wait_for(self.get_request(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+        while True:
+            while not len(self.scheduler):
+                getter = asyncio.get_running_loop().create_future()
+                self.getters.append(getter)
+                try:
+                    await getter
+                except:
+                    getter.cancel()
+                    try:
+                        self.getters.remove(getter)
+                    except ValueError:
+                        pass
+                    # Passing wake up to the next executor
+                    if len(self.scheduler) and not getter.cancelled():
+                        self.wakeup_next()
+                    raise
+            request = self.get_request_nowait()
+            if request is not None:
+                return request
+
+    def get_request_nowait(self) -> Union[GenerationRequest, None]:
+        '''Returns next request or None if queue is empty, cancelled and expired requests are dropped'''
+        while len(self.scheduler):
+            request = self.scheduler.pop()
+            request.queue = None
+            if request.cancelled:
+                self.tombstones[bool(request.premium)] -= 1
+                request.drop_payload()
+                continue
+            self.work -= request.work
+            self.count_service(request, -1)
+            if AdmissionControl.expired(request):
+                # Expired payload is never generated, not worth reading back
+                request.drop_payload()
+                asyncio.get_running_loop().create_task(AdmissionControl.expire(request, self))
+                continue
+            request.load_payload()
+            return request
+        return None
+
+    def cancel(self, request: GenerationRequest) -> None:
+        '''Leaves request in scheduler as a tombstone, O(1)'''
+        self.tombstones[bool(request.premium)] += 1
+        self.work -= request.work
+        self.count_service(request, -1)
+
+    def count_service(self, request: GenerationRequest, delta: int) -> None:
+        size = self.service_sizes.get(request.service, 0) + delta
+        if size > 0:
+            self.service_sizes[request.service] = size
+        else:
+            self.service_sizes.pop(request.service, None)
+
+    def get_service_size(self, service: Service) -> int:
+        return self.service_sizes.get(service, 0)
+
+    @property
+    def general_size(self) -> int:
+        return self.scheduler.general_size - self.tombstones[False]
+
+    @property
+    def premium_size(self) -> int:
+        return self.scheduler.premium_size - self.tombstones[True]
+
     def get_total_size(self) -> int:
-        return self.general_queue.qsize() +\
-            self.premium_queue.qsize()
-    
-    def get_general(self):
-        request = self.general_queue.get_nowait()
-        self.general_size -= 1
-        return request
-    
-    def get_premium(self):
-        request = self.premium_queue.get_nowait()
-        self.premium_size -= 1
-        return request
-    
+        return len(self.scheduler) - self.tombstones[False] - self.tombstones[True]
+
     def put_general(self, request: GenerationRequest):
-        self.general_queue.put_nowait(request)
-        self.general_size += 1
-        
+        if request.cancelled:
+            # Cancelled while held outside of any queue, no tombstone to count
+            return
+        # Kept when the dispatcher moves request to an inbox
+        if request.queued_at is None:
+            request.queued_at = perf_counter()
+        request.queue = self
+        if self.spill:
+            request.spill_payload()
+        self.scheduler.push(request, False)
+        self.work += request.work
+        self.count_service(request, 1)
+        self.wakeup_next()
+
     def put_premium(self, request: GenerationRequest):
-        self.premium_queue.put_nowait(request)
-        self.premium_size += 1
\ No newline at end of file
+        if request.cancelled:
+            return
+        if request.queued_at is None:
+            request.queued_at = perf_counter()
+        request.queue = self
+        if self.spill:
+            request.spill_payload()
+        self.scheduler.push(request, True)
+        self.work += request.work
+        self.count_service(request, 1)
+        self.wakeup_next()
+
+    def put_back(self, request: GenerationRequest):
+        '''Returns taken request to the head of the queue'''
+        if request.cancelled:
+            return
+        request.queue = self
+        if self.spill:
+            request.spill_payload()
+        self.scheduler.push_front(request, bool(request.premium))
+        self.work += request.work
+        self.count_service(request, 1)
+        self.wakeup_next()
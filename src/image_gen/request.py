@@ -1,16 +1,29 @@
 from enums import *
 from bson.objectid import ObjectId
 
-from typing import Union, Tuple
+from base64 import b64encode
+from typing import Union, Dict
 from collections.abc import Coroutine
 
+
 from utils.database import DevoidDatabase
+from utils.json_codec import Raw, dumps
+from utils.payload_store import PayloadStore
+from utils.metrics import Metrics
 
 from .avg_time import AvgTimeCalc
+from .cost_model import CostModel
 
 from asyncio import Lock
 
 class GenerationRequest():
+    # Thousands of requests may be queued, no per-instance __dict__
+    __slots__ = ('object_id', 'saved', 'service', 'message_type', 'executor', 'gen_type',\
+        'settings', 'service_info', 'payload', 'payload_json', 'spilled', 'work', 'pixels',\
+        'gen_status', 'result_type', 'result', 'result_image', 'error_message', 'file_name',\
+        'variants', 'avg_time', 'ws_handler', 'queued_at', 'executor_name', 'cache_key', 'retries',\
+        'request_lock', 'cancelled', 'queue', 'task', '__weakref__')
+
     object_id: ObjectId
     service: Service
         
@@ -27,8 +40,10 @@ class GenerationRequest():
     result_type: Union[ContentType, None]
     result: Union[str, None]
     file_name: Union[str, None]
+    variants: Union[Dict[str, str], None]
+    '''Urls of encoded variants (thumbnails, previews) by name'''
     
-    lock: Lock
+    request_lock: Union[Lock, None]
     
     def __init__(
             self, 
@@ -36,7 +51,8 @@ class GenerationRequest():
             message: dict,
             ws_handler: Coroutine
         ) -> None:
-        self.object_id = None
+        self.object_id = ObjectId()
+        self.saved = False
         self.service = service
         self.message_type = MessageType(message.get('message_type'))
         self.executor = ExecutorType(message.get('executor'))
@@ -44,66 +60,177 @@ class GenerationRequest():
         self.settings = message.get('settings')
         self.service_info = message.get('service_info')
         self.payload = message.get('payload')
+        self.payload_json = None
+        self.spilled = False
+        # Predicted cost
+        self.work = CostModel.work(self.executor, self.gen_type, self.payload)
+        self.pixels = CostModel.get_pixels(self.payload)
         # Response fields
         self.gen_status = GenStatus.QUEUED
         self.result_type = None
+        self.result = None
         self.result_image = None
         self.error_message = None
         self.file_name = None
+        self.variants = None
         # Websocket Message Sender
         self.avg_time = None
         self.ws_handler = ws_handler
+        # Filled by queue and executor
+        self.queued_at = None
+        self.executor_name = None
+        self.cache_key = None
+        self.retries = 0
         
-        self.lock = Lock()
+        self.request_lock = None
+        # Cancellation, queue holding the request or task generating it
+        self.cancelled = False
+        self.queue = None
+        self.task = None
+
+    @property
+    def lock(self) -> Lock:
+        '''Created on first use'''
+        if self.request_lock is None:
+            self.request_lock = Lock()
+        return self.request_lock
+
+    def spill_payload(self) -> None:
+        '''Moves large payload strings to disk while request is queued'''
+        if self.spilled or not PayloadStore.enabled() or not PayloadStore.needs_spill(self.payload):
+            return
+        self.payload = PayloadStore.spill(self.payload)
+        self.spilled = True
+
+    def load_payload(self) -> None:
+        '''Reads spilled payload back before generation'''
+        if not self.spilled:
+            return
+        self.payload = PayloadStore.load(self.payload)
+        self.spilled = False
+
+    def drop_payload(self) -> None:
+        '''Frees spilled payload of request that will not be generated'''
+        if not self.spilled:
+            return
+        PayloadStore.discard(self.payload)
+        self.payload = {}
+        self.spilled = False
+
+    def get_payload(self) -> dict:
+        '''Full payload, spilled strings are read without loading them back'''
+        if self.spilled:
+            return PayloadStore.load(self.payload, release=False)
+        return self.payload
         
-    async def save(self) -> None:
-        if self.object_id is None:
-            result = await DevoidDatabase.insert_request(self.as_dict())
-            self.object_id = result.inserted_id
+    @classmethod
+    def restore(cls, document: dict, ws_handler: Coroutine) -> 'GenerationRequest':
+        '''Rebuilds saved request, its state is left to the caller'''
+        request = cls(Service(document['service']), {
+            'message_type': MessageType.REQUEST.value,
+            'executor': document['executor'],
+            'gen_type': document['gen_type'],
+            'settings': document.get('settings') or {},
+            'service_info': document.get('service_info') or {},
+            'payload': document.get('payload') or {}
+        }, ws_handler)
+        request.object_id = document['_id']
+        request.saved = True
+        return request
+
+    def save(self) -> None:
+        '''Queues state for write-behind, full document only on first save'''
+        if not self.saved:
+            DevoidDatabase.write_request(self.object_id, self.as_dict())
+            self.saved = True
         else:
-            await DevoidDatabase.update_request(self.object_id, self.as_dict())
+            DevoidDatabase.write_request(self.object_id, self.as_state_dict())
 
-    async def set_ok(self, result_type: ContentType, result, file_name) -> None:
+    async def set_ok(self, result_type: ContentType, result, file_name, variants: dict = None) -> None:
         self.gen_status = GenStatus.OK
         self.result_type = result_type
         self.result = result
         self.file_name = file_name
-        await self.save()
+        self.variants = variants or None
+        self.save()
     
     async def send_to_client(self):
+        '''Queues state for the client, send time is observed by the connection writer'''
+        labels = Metrics.request_labels(self)
         if self.gen_status in [GenStatus.QUEUED, GenStatus.GENERATING]:
-            await self.ws_handler(self.service, self.as_short_dict())
+            await self.ws_handler(self.service, self.as_short_dict(), labels=labels)
         else:
-            await self.ws_handler(self.service, self.as_dict())
+            await self.ws_handler(self.service, self.as_dict(encoded_payload=True), labels=labels)
     
-    async def set_queued(self, queue_size: Tuple[int, int]) -> None:
-        self.gen_status = GenStatus.QUEUED
+    async def send_image(self, image_bytes: bytes) -> None:
+        '''Sends result image itself instead of its url, `binary` delivery uses a binary frame'''
+        labels = Metrics.request_labels(self)
+        message = self.as_short_dict()
+        if self.delivery == 'binary':
+            message['result'] = {
+                'content_type': ContentType.BINARY.value,
+                'content': None,
+                'file_name': self.file_name
+            }
+            await self.ws_handler(self.service, message, data=image_bytes, labels=labels)
+        else:
+            message['result'] = {
+                'content_type': ContentType.BASE64.value,
+                'content': b64encode(image_bytes).decode(),
+                'file_name': self.file_name
+            }
+            await self.ws_handler(self.service, message, labels=labels)
 
-        queue_size = sum(queue_size)
-        gen_count = AvgTimeCalc.executors.get(self.executor)
-        if gen_count is None or len(gen_count) == 0:
-            self.avg_time = None
-        elif self.executor == ExecutorType.AUTOMATIC1111:
-            self.avg_time = (AvgTimeCalc.auto_avg_time * queue_size) / len(gen_count)
-            if self.avg_time < 4:
-                self.avg_time = 4
-        elif self.executor == ExecutorType.KANDINSKY:
-            self.avg_time = (AvgTimeCalc.kand_avg_time * queue_size) / len(gen_count)
-            if self.avg_time < 4:
-                self.avg_time = 4
-        
-        self.avg_time = round(self.avg_time, 2)
-        await self.save()
+    def predict_wait(self, queue_work: float) -> Union[float, None]:
+        '''Seconds to generate `queue_work` on alive executors, None if there are none'''
+        executors = AvgTimeCalc.executors.get(self.executor)
+        if executors is None or len(executors) == 0:
+            return None
+        return round(queue_work / CostModel.capacity(executors, self.pixels), 2)
+
+    async def set_queued(self, queue_work: float) -> None:
+        '''`queue_work` is predicted work of queued requests, this one included'''
+        self.gen_status = GenStatus.QUEUED
+        self.avg_time = self.predict_wait(queue_work)
+        self.save()
     
+    async def cancel(self, reason: str = 'Request cancelled') -> bool:
+        '''Stops queued or generating request, False if it is already done'''
+        if self.cancelled or self.gen_status not in (GenStatus.QUEUED, GenStatus.GENERATING):
+            return False
+        if self.queue is not None and self.queue.remote:
+            # Copy in shared queue, it may be generating or done elsewhere
+            return await self.queue.cancel_request(self, reason)
+        self.cancelled = True
+        stage = self.gen_status.value
+        if self.queue is not None:
+            # Tombstone, queue skips it when popped
+            self.queue.cancel(self)
+        elif self.task is not None:
+            self.task.cancel()
+        Metrics.cancelled.inc(self.executor.value, self.service.value, stage)
+        async with self.lock:
+            await self.set_cancelled(reason)
+            await self.send_to_client()
+        return True
+
+    async def set_cancelled(self, reason: str) -> None:
+        self.gen_status = GenStatus.CANCELLED
+        self.result_type = ContentType.TEXT
+        self.result = reason
+        self.error_message = reason
+        self.save()
+
     async def set_generating(self) -> None:
         self.gen_status = GenStatus.GENERATING
-        await self.save()
+        self.save()
     
     async def set_error(self, message) -> None:
         self.gen_status = GenStatus.ERROR
         self.result_type = ContentType.TEXT
         self.result = message
-        await self.save()
+        self.error_message = message
+        self.save()
     
     def as_short_dict(self):
         return {
@@ -117,14 +244,23 @@ class GenerationRequest():
             'service_info': self.service_info
         }
     
-    def as_dict(self) -> dict:
+    def as_state_dict(self) -> dict:
+        '''Fields changed by state transitions'''
+        return {
+            'gen_status': self.gen_status.value,
+            'result': self.get_result()
+        }
+
+    def get_result(self) -> Union[dict, None]:
         if self.gen_status == GenStatus.OK:
             result = {
                 'content_type': self.result_type.value,
                 'content': self.result,
                 'file_name': self.file_name
             }
-        elif self.gen_status == GenStatus.ERROR:
+            if self.variants:
+                result['variants'] = self.variants
+        elif self.gen_status in (GenStatus.ERROR, GenStatus.CANCELLED):
             result = {
                 'content_type': self.result_type.value,
                 'content': self.error_message
@@ -133,7 +269,16 @@ class GenerationRequest():
             result = None
         elif self.gen_status == GenStatus.GENERATING:
             result = None
-        
+        return result
+
+    def get_payload_json(self) -> Raw:
+        '''Payload encoded once per request, may hold MBs of init images'''
+        if self.payload_json is None:
+            self.payload_json = Raw(dumps(self.get_payload()))
+        return self.payload_json
+
+    def as_dict(self, encoded_payload: bool = False) -> dict:
+        '''`encoded_payload` embeds cached payload JSON, for `json_codec.dumps` only'''
         return {
             'object_id': str(self.object_id),
             'service': self.service.value,
@@ -141,10 +286,11 @@ class GenerationRequest():
             'executor': self.executor.value,
             'gen_type': self.gen_type.value,
             'gen_status': self.gen_status.value,
-            'result': result,
+            'avg_time': self.avg_time,
+            'result': self.get_result(),
             'settings': self.settings,
             'service_info': self.service_info,
-            'payload': self.payload
+            'payload': self.get_payload_json() if encoded_payload else self.get_payload()
         }
     
     @property
@@ -155,6 +301,22 @@ class GenerationRequest():
     def moderate(self) -> bool:
         return self.settings.get('moderate')
     
+    @property
+    def delivery(self) -> str:
+        '''`url`, `base64` or `binary`'''
+        delivery = self.settings.get('delivery') or 'url'
+        return delivery if delivery in ('base64', 'binary') else 'url'
+
+    @property
+    def upload(self) -> bool:
+        '''Whether inline delivered image is uploaded to S3 too'''
+        return self.settings.get('upload', True)
+
+    @property
+    def deadline(self) -> Union[float, None]:
+        '''Seconds after submission when request is cancelled'''
+        return self.settings.get('deadline')
+
     @property
     def sync_with_s3(self) -> bool:
         return self.settings.get('sync_with_s3')
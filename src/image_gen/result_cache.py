@@ -0,0 +1,102 @@
+import json
+import time
+import asyncio
+import logging
+import hashlib
+
+from os import getenv
+from typing import Union, Tuple, Dict
+from collections import OrderedDict
+
+from utils.database import DevoidDatabase
+
+from .request import GenerationRequest
+from .encoding import OutputEncoding
+
+class ResultCache():
+    '''Results of fixed-seed requests, in-memory LRU in front of MongoDB'''
+    entries: 'OrderedDict[str, Tuple[float, str, str, Dict[str, str]]]' = OrderedDict()
+    '''Cache key -> (expires at, image url, file name, variant urls)'''
+    max_size = int(getenv('RESULT_CACHE_SIZE', 10000))
+    ttl = float(getenv('RESULT_CACHE_TTL', 86400))
+    '''Seconds, 0 disables caching'''
+
+    @staticmethod
+    def cache_key(request: GenerationRequest) -> Union[str, None]:
+        '''Canonical hash of request, None if result is not deterministic'''
+        payload = request.payload
+        if not isinstance(payload, dict):
+            return None
+        seed = payload.get('seed')
+        if not isinstance(seed, int) or seed < 0:
+            return None
+        if payload.get('batch_size', 1) != 1 or payload.get('n_iter', 1) != 1:
+            return None
+        model = (payload.get('override_settings') or {}).get('sd_model_checkpoint') or payload.get('model')
+        # Same image encoded differently is another result
+        encoding = OutputEncoding.resolve(request)
+        canonical = json.dumps([request.executor.value, request.gen_type.value, model, payload, encoding],\
+            sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    @classmethod
+    def remember(
+            cls,
+            key: str,
+            expires_at: float,
+            image_url: str,
+            file_name: str,
+            variants: Dict[str, str] = None
+        ) -> None:
+        cls.entries[key] = (expires_at, image_url, file_name, variants)
+        cls.entries.move_to_end(key)
+        while len(cls.entries) > cls.max_size:
+            cls.entries.popitem(last=False)
+
+    @classmethod
+    async def get(cls, request: GenerationRequest) -> Union[Tuple[str, str, Dict[str, str]], None]:
+        '''Returns (image url, file name, variant urls) of cached result, sets `request.cache_key`'''
+        if cls.ttl <= 0:
+            return None
+        key = request.cache_key = cls.cache_key(request)
+        if key is None:
+            return None
+
+        now = time.time()
+        entry = cls.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                cls.entries.move_to_end(key)
+                return entry[1:]
+            del cls.entries[key]
+
+        try:
+            document = await DevoidDatabase.find_cached_result(key)
+        except Exception as e:
+            logging.error(f'Cannot read result cache: {e}')
+            return None
+        if document is None:
+            return None
+        # Mongo TTL monitor removes documents with a delay
+        expires_at = document['created_at'] + cls.ttl
+        if expires_at <= now:
+            return None
+        cls.remember(key, expires_at, document['image_url'], document['file_name'],\
+            document.get('variants'))
+        return document['image_url'], document['file_name'], document.get('variants')
+
+    @classmethod
+    def put(
+            cls,
+            request: GenerationRequest,
+            image_url: str,
+            file_name: str,
+            variants: Dict[str, str] = None
+        ) -> None:
+        key = request.cache_key
+        if cls.ttl <= 0 or key is None:
+            return
+        now = time.time()
+        cls.remember(key, now + cls.ttl, image_url, file_name, variants)
+        asyncio.get_running_loop().create_task(\
+            DevoidDatabase.cache_result(key, image_url, file_name, now, variants))
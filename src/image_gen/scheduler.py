@@ -0,0 +1,250 @@
+from typing import Tuple, Dict, Deque, Hashable, Callable, Any
+from collections import deque
+
+from enums import Service
+
+from .request import GenerationRequest
+
+class AbstractScheduler():
+    '''Decides in which order queued requests are handed to executors'''
+
+    def push(self, request: GenerationRequest, premium: bool) -> None:
+        raise NotImplementedError('`push` not implemented')
+
+    def push_front(self, request: GenerationRequest, premium: bool) -> None:
+        '''Returns request to the head of its queue, its turn is given back'''
+        raise NotImplementedError('`push_front` not implemented')
+
+    def pop(self) -> GenerationRequest:
+        '''Returns next request, scheduler must not be empty'''
+        raise NotImplementedError('`pop` not implemented')
+
+    @property
+    def general_size(self) -> int:
+        raise NotImplementedError('`general_size` not implemented')
+
+    @property
+    def premium_size(self) -> int:
+        raise NotImplementedError('`premium_size` not implemented')
+
+    def __len__(self) -> int:
+        return self.general_size + self.premium_size
+
+
+class RatioScheduler(AbstractScheduler):
+    '''Serves `ratio[0]` general requests per `ratio[1]` premium ones'''
+    general_queue: Deque[GenerationRequest]
+    premium_queue: Deque[GenerationRequest]
+    ratio: Tuple[int, int]
+
+    def __init__(self, ratio: Tuple[int, int]) -> None:
+        self.general_queue = deque()
+        self.premium_queue = deque()
+
+        self.ratio = ratio
+
+        self.cur_general_count = 0
+        self.cur_premium_count = 0
+
+    def push(self, request: GenerationRequest, premium: bool) -> None:
+        if premium:
+            self.premium_queue.append(request)
+        else:
+            self.general_queue.append(request)
+
+    def push_front(self, request: GenerationRequest, premium: bool) -> None:
+        if premium:
+            self.premium_queue.appendleft(request)
+            self.cur_premium_count = max(self.cur_premium_count - 1, 0)
+        else:
+            self.general_queue.appendleft(request)
+            self.cur_general_count = max(self.cur_general_count - 1, 0)
+
+    def pop(self) -> GenerationRequest:
+        for _ in range(2):
+            if self.cur_general_count >= self.ratio[0] and \
+                    self.cur_premium_count >= self.ratio[1]:
+                self.cur_general_count = 0
+                self.cur_premium_count = 0
+
+            if self.cur_general_count < self.ratio[0]:
+                self.cur_general_count += 1
+                if self.general_queue:
+                    return self.general_queue.popleft()
+            if self.cur_premium_count < self.ratio[1]:
+                self.cur_premium_count += 1
+                if self.premium_queue:
+                    return self.premium_queue.popleft()
+
+        # Ratio turns went to an empty queue, serve whatever is left
+        if self.general_queue:
+            return self.general_queue.popleft()
+        return self.premium_queue.popleft()
+
+    @property
+    def general_size(self) -> int:
+        return len(self.general_queue)
+
+    @property
+    def premium_size(self) -> int:
+        return len(self.premium_queue)
+
+
+class FifoScheduler(AbstractScheduler):
+    '''Keeps arrival order, used for executor inboxes'''
+    requests: Deque[GenerationRequest]
+
+    def __init__(self) -> None:
+        self.requests = deque()
+        self.premium_count = 0
+
+    def push(self, request: GenerationRequest, premium: bool) -> None:
+        self.requests.append(request)
+        self.premium_count += bool(premium)
+
+    def push_front(self, request: GenerationRequest, premium: bool) -> None:
+        self.requests.appendleft(request)
+        self.premium_count += bool(premium)
+
+    def pop(self) -> GenerationRequest:
+        request = self.requests.popleft()
+        self.premium_count -= bool(request.premium)
+        return request
+
+    @property
+    def general_size(self) -> int:
+        return len(self.requests) - self.premium_count
+
+    @property
+    def premium_size(self) -> int:
+        return self.premium_count
+
+
+class _DeficitRoundRobin():
+    '''Deficit round-robin over child flows, every request costs 1'''
+    active: Deque[Hashable]
+    flows: Dict[Hashable, Any]
+    deficit: Dict[Hashable, float]
+    quantum: Callable[[Hashable], float]
+    size: int
+
+    def __init__(self, quantum: Callable[[Hashable], float], make_flow: Callable[[Hashable], Any]) -> None:
+        self.active = deque()
+        self.flows = {}
+        self.deficit = {}
+        self.quantum = quantum
+        self.make_flow = make_flow
+        self.size = 0
+
+    def flow(self, key: Hashable, front: bool = False):
+        '''Returns flow by key, activating it if needed.
+
+        `front` is for returned requests: flow goes to the head of the round
+        with the turn its request was popped with.
+        '''
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = self.flows[key] = self.make_flow(key)
+            self.deficit[key] = 0.0
+            if front:
+                self.active.appendleft(key)
+            else:
+                self.active.append(key)
+        elif front:
+            self.deficit[key] = min(self.deficit[key] + 1, self.quantum(key))
+            if self.active[0] != key:
+                self.active.remove(key)
+                self.active.appendleft(key)
+        return flow
+
+    def pop_from(self, pop_item: Callable[[Any], GenerationRequest]) -> GenerationRequest:
+        key = self.active[0]
+        if self.deficit[key] < 1:
+            # Flow got its turn, grant quantum (always >= 1)
+            self.deficit[key] += self.quantum(key)
+
+        flow = self.flows[key]
+        request = pop_item(flow)
+        self.size -= 1
+        self.deficit[key] -= 1
+
+        if not flow:
+            # Empty flows leave the round and lose their deficit
+            self.active.popleft()
+            del self.flows[key]
+            del self.deficit[key]
+        elif self.deficit[key] < 1:
+            self.active.rotate(-1)
+        return request
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class FairScheduler(AbstractScheduler):
+    '''Weighted deficit round-robin by (service, premium), then by user.
+
+    Class weight is `service_weights[service] * ratio[premium]`, users inside
+    a class share it by `user_weights[(service, user_id)]` (1 by default).
+    Push and pop are O(1).
+    '''
+    ratio: Tuple[int, int]
+    service_weights: Dict[Service, float]
+    user_weights: Dict[Tuple[Service, Any], float]
+
+    def __init__(
+            self,
+            ratio: Tuple[int, int],
+            service_weights: Dict[Service, float] = None,
+            user_weights: Dict[Tuple[Service, Any], float] = None
+        ) -> None:
+        self.ratio = ratio
+        self.service_weights = service_weights or {}
+        self.user_weights = user_weights or {}
+
+        # Quantums are normalized so the lightest flow gets at least 1 per round
+        weights = [w for w in (*ratio, *self.service_weights.values(),\
+            *self.user_weights.values(), 1) if w > 0]
+        self.base_weight = min(weights)
+
+        self.classes = _DeficitRoundRobin(self.class_quantum, self.make_class)
+
+    def class_quantum(self, key: Tuple[Service, bool]) -> float:
+        service, premium = key
+        weight = self.service_weights.get(service, 1) * self.ratio[int(premium)]
+        return max(weight, self.base_weight) / self.base_weight
+
+    def make_class(self, key: Tuple[Service, bool]) -> _DeficitRoundRobin:
+        service, _ = key
+        quantum = lambda user_id: max(self.user_weights.get((service, user_id), 1),\
+            self.base_weight) / self.base_weight
+        return _DeficitRoundRobin(quantum, lambda user_id: deque())
+
+    def push(self, request: GenerationRequest, premium: bool) -> None:
+        users = self.classes.flow((request.service, bool(premium)))
+        users.flow(request.user_id).append(request)
+        users.size += 1
+        self.classes.size += 1
+
+    def push_front(self, request: GenerationRequest, premium: bool) -> None:
+        users = self.classes.flow((request.service, bool(premium)), front=True)
+        users.flow(request.user_id, front=True).appendleft(request)
+        users.size += 1
+        self.classes.size += 1
+
+    def pop(self) -> GenerationRequest:
+        return self.classes.pop_from(lambda users: users.pop_from(deque.popleft))
+
+    def tier_size(self, premium: bool) -> int:
+        return sum(len(users) for (_, tier), users in self.classes.flows.items() if tier == premium)
+
+    @property
+    def general_size(self) -> int:
+        return self.tier_size(False)
+
+    @property
+    def premium_size(self) -> int:
+        return self.tier_size(True)
+
+    def __len__(self) -> int:
+        return len(self.classes)
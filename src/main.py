@@ -1,5 +1,6 @@
 import os
 import json
+import signal
 import logger
 import asyncio
 
@@ -9,12 +10,21 @@ load_dotenv()
 from server.fastapi_server import GeneratorRestAPI
 from utils.database import DevoidDatabase
 from utils.storage import Storage
+from utils.compress import ImageCompressor
+from utils.payload_store import PayloadStore
 
-from enums import ExecutorType
+from enums import ExecutorType, Service
 from image_gen import ImageGenerator
 from image_gen.avg_time import AvgTimeCalc
+from image_gen.cost_model import CostModel
+from image_gen.result_cache import ResultCache
+from image_gen.admission import AdmissionControl
+from image_gen.encoding import OutputEncoding
+
+generator: ImageGenerator = None
 
 async def main():
+    global generator
     logger.setup()
         
     AvgTimeCalc.update_ratio()
@@ -27,10 +37,38 @@ async def main():
     secret_key = os.getenv('S3_SECRET_KEY')
     bucket_name = os.getenv('S3_BUCKET_NAME')
     await Storage.init(api_host, access_key, secret_key, bucket_name)
+    ImageCompressor.init()
+    PayloadStore.init()
 
     # Image generator
     a, b = map(int, os.getenv('GENERAL_PREMIUM_RATIO').split())
-    generator = ImageGenerator((a, b))
+    service_weights = {}
+    for weight in os.getenv('SERVICE_WEIGHTS', '').split():
+        values = weight.split(':')
+        service_weights[Service(values[0])] = float(values[1])
+    user_weights = {}
+    for weight in os.getenv('USER_WEIGHTS', '').split():
+        values = weight.split(':')
+        user_weights[(Service(values[0]), int(values[1]))] = float(values[2])
+    generator = ImageGenerator((a, b), os.getenv('QUEUE_SCHEDULER', 'ratio'),\
+        service_weights, user_weights, os.getenv('DISPATCH_STRATEGY', 'pull'),\
+        int(os.getenv('DISPATCH_DEPTH', 1)), os.getenv('QUEUE_BACKEND', 'memory'))
+        
+    # Admission control
+    max_queue_depth = {}
+    for limit in os.getenv('MAX_QUEUE_DEPTH', '').split():
+        values = limit.split(':')
+        max_queue_depth[ExecutorType(values[0])] = int(values[1])
+    max_service_queue = {}
+    for limit in os.getenv('MAX_SERVICE_QUEUE', '').split():
+        values = limit.split(':')
+        max_service_queue[Service(values[0])] = int(values[1])
+    eta_slo = {}
+    for slo in os.getenv('ETA_SLO', '').split():
+        values = slo.split(':')
+        eta_slo[values[0] == 'premium'] = float(values[1])
+    AdmissionControl.configure(max_queue_depth, max_service_queue, eta_slo,\
+        float(os.getenv('GENERAL_DEADLINE', 0)))
         
     # Database
     db = DevoidDatabase()
@@ -39,6 +77,17 @@ async def main():
     # Rest API
     api = GeneratorRestAPI(generator, verify_tokens=True)
 
+    # Loading GPU profiles
+    with open('data/gpu.json', 'r') as file:
+        CostModel.load(json.load(file))
+
+    # Loading output encodings of services
+    encodings = {}
+    if os.path.exists('data/encoding.json'):
+        with open('data/encoding.json', 'r') as file:
+            encodings = json.load(file)
+    OutputEncoding.configure(encodings)
+
     # Loading executors
     with open('data/executors.json', 'r') as file:
         executors = json.load(file)
@@ -49,14 +98,37 @@ async def main():
         timeout = float(executor.get('timeout'))
         model = executor.get('model')
         exec_type = ExecutorType(executor.get('exec_type'))
-        generator.add_executor(exec_type, name, endpoint, gpu, timeout, model)
+        batch_window = float(executor.get('batch_window', 0))
+        max_batch_size = int(executor.get('max_batch_size', 1))
+        slots = int(executor.get('slots', executor.get('max_concurrency', 1)))
+        generator.add_executor(exec_type, name, endpoint, gpu, timeout, model,\
+            batch_window, max_batch_size, slots)
 
     # Starting
     db.connect(os.getenv('MONGODB_URI'), loop)
+    db.start_writer(loop)
+    await db.create_indexes(ResultCache.ttl)
+    # Unfinished requests of previous run go before new ones
+    await generator.recover()
     api.start(loop)
     generator.start(loop)
 
+async def shutdown():
+    if generator is not None:
+        await generator.close()
+    # Flushing write-behind requests
+    await DevoidDatabase.close()
+    await Storage.close()
+    ImageCompressor.close()
+    PayloadStore.close()
+
 if __name__ == '__main__':
     loop = asyncio.new_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
     loop.create_task(main())
-    loop.run_forever()
\ No newline at end of file
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(shutdown())
\ No newline at end of file
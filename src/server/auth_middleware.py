@@ -1,25 +1,34 @@
-from fastapi import Request
+from starlette.datastructures import Headers
 from starlette.responses import JSONResponse
 
 class AuthMiddleware:
-    services: list
-        
-    def __init__(self, services):
+    '''Verifies the token in the request header.
+
+    Plain ASGI middleware, public routes (images above all) are passed to the
+    app without wrapping their responses.
+    '''
+    services: dict
+
+    public_paths = ('/favicon.ico', '/', '/openapi.json', '/docs', '/metrics')
+
+    def __init__(self, app, services):
+        self.app = app
         self.services = services
-        
-    async def __call__(self, request: Request, call_next):
-        '''Verifies the token in the request header'''
-        print(request.url.path)
-        if request.url.path.startswith('/img/') or request.url.path in ('/favicon.ico', '/', '/openapi.json', '/docs'):
-            response = await call_next(request)
-            return response
-        try:
-            service = request.headers["service"]
-            token = request.headers["authorization"]
-            if service in self.services:
-                if self.services[service] == token:
-                    response = await call_next(request)
-                    return response
-            return JSONResponse(content='Invalid Authorization', status_code=401)
-        except KeyError as er:
-            return JSONResponse(content='Invalid Authorization', status_code=401)
\ No newline at end of file
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            # Websockets verify tokens themselves
+            await self.app(scope, receive, send)
+            return
+        path = scope['path']
+        if path.startswith('/img/') or path in self.public_paths:
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        service = headers.get("service")
+        token = headers.get("authorization")
+        if service in self.services and self.services[service] == token:
+            await self.app(scope, receive, send)
+            return
+        response = JSONResponse(content='Invalid Authorization', status_code=401)
+        await response(scope, receive, send)
@@ -3,18 +3,21 @@ import logging
 
 from typing import Dict
 from os import getenv
-from os.path import exists
 from threading import Thread
 from uvicorn import Config, Server
-from starlette.responses import JSONResponse, FileResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 
+from enums import ExecutorType
+from utils.metrics import Metrics
+from utils.image_store import ImageStore
 from image_gen import ImageGenerator
+from image_gen.avg_time import AvgTimeCalc
 
 from .schemas import *
 from .gateway import WebsocketManager
 from .auth_middleware import AuthMiddleware
+from .image_response import ImageResponse
 
 class GeneratorRestAPI(FastAPI):
     thread: Thread
@@ -39,28 +42,39 @@ class GeneratorRestAPI(FastAPI):
         self.ws_manager = WebsocketManager(self.services, generator)
         
         self.image_get_url = getenv('API_IMAGE_GET_URL')
-        self.images_path = getenv('IMAGES_PATH')
         
         # Register routes
         self.add_api_route("/", self.homepage_get, methods=["GET"])
-        self.add_api_route("/img/{file_name}", self.image_get, methods=["GET"])
+        self.add_api_route("/img/{file_name}", self.image_get, methods=["GET", "HEAD"])
+        self.add_api_route("/metrics", self.metrics_get, methods=["GET"])
         self.add_api_websocket_route("/ws/{service}", self.ws_manager.endpoint)
         
         # Enable token verification
         if verify_tokens:
-            auth_middleware = AuthMiddleware(self.services)
-            self.add_middleware(BaseHTTPMiddleware, dispatch=auth_middleware)
+            self.add_middleware(AuthMiddleware, services=self.services)
         
     async def homepage_get(self):
         return JSONResponse({'RestAPI': 'Devoid Image Generator',\
             'website': 'https://web.devoid.pics/'}, status_code=200)
 
-    async def image_get(self, file_name: str):
+    async def image_get(self, request: Request, file_name: str):
         '''Returns the image with the given id'''
-        path = f'{self.images_path}/{file_name}'
-        if not exists(path):
+        image = ImageStore.get(file_name)
+        if image is None:
             return JSONResponse({"content": "Image not found"}, status_code=404)
-        return FileResponse(path, media_type='image/jpg')
+        return ImageResponse(image, request.headers, request.method)
+    
+    async def metrics_get(self):
+        '''Returns metrics in Prometheus text format'''
+        queues = {
+            ExecutorType.AUTOMATIC1111: self.generator.automatic1111_queue,
+            ExecutorType.KANDINSKY: self.generator.kandinsky_queue
+        }
+        for exec_type, queue in queues.items():
+            Metrics.queue_depth.set(queue.general_size, exec_type.value, '0')
+            Metrics.queue_depth.set(queue.premium_size, exec_type.value, '1')
+            Metrics.alive_executors.set(len(AvgTimeCalc.executors.get(exec_type, [])), exec_type.value)
+        return PlainTextResponse(Metrics.render(), media_type='text/plain; version=0.0.4')
     
     def start(self, loop = None):
         if loop is None:
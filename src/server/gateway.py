@@ -1,15 +1,33 @@
+import asyncio
 import logging
 
-from typing import Dict
+from os import getenv
+from typing import Dict, Deque, List, Tuple
+from functools import partial
+from collections import deque
 from fastapi import WebSocket, WebSocketDisconnect
 from image_gen.avg_time import AvgTimeCalc
+from image_gen.result_cache import ResultCache
+from image_gen.admission import AdmissionControl
 from image_gen import ImageGenerator, GenerationRequest
 from enums import *
+from utils.json_codec import loads
+
+from .outbound import OutboundQueue, FINAL_STATUSES
 
 class WebsocketManager():    
     services: Dict[str, str]
-    connections: Dict[str, WebSocket]
+    connections: Dict[Service, List[OutboundQueue]]
+    '''Connection pool of every service'''
+    outbound_services: Dict[OutboundQueue, Service]
+    pending: Dict[Service, Deque[Tuple[dict, bytes, tuple]]]
+    '''Results waiting for service to reconnect'''
+    pending_bytes: Dict[Service, int]
+    '''Image bytes held by results waiting for service'''
     generator: ImageGenerator
+
+    pending_limit = int(getenv('WS_PENDING_LIMIT', 10000))
+    pending_bytes_limit = int(getenv('WS_PENDING_BYTES', 268435456))
      
     def __init__(
             self, 
@@ -18,7 +36,11 @@ class WebsocketManager():
         ) -> None:
         self.services = services
         self.connections = {}
+        self.outbound_services = {}
+        self.pending = {}
+        self.pending_bytes = {}
         self.generator = generator
+        self.generator.set_ws_handler(self.send_message)
     
     async def endpoint(self, websocket: WebSocket, service: str):
         if not self.verify_token(websocket, service):
@@ -26,44 +48,69 @@ class WebsocketManager():
             return
         
         service = Service(service)
-        await self.connect(websocket, service)
+        outbound = await self.connect(websocket, service)
+        # Replies go back to the connection that sent the request
+        ws_handler = partial(self.send_message, connection=outbound)
         
         try:
             while True:
-                message = await websocket.receive_json()
+                message = await self.receive_message(websocket)
                 if message["message_type"] == MessageType.REQUEST.value:
                     logging.info(f'New request from {service.name}')
-                    request = GenerationRequest(service, message, self.send_message)
+                    request = GenerationRequest(service, message, ws_handler)
 
-                    executors = AvgTimeCalc.executors.get(request.executor)
-                    if executors is None or len(executors) == 0:
+                    # Same fixed-seed request was already generated
+                    cached = await ResultCache.get(request)
+                    if cached is not None:
+                        async with request.lock:
+                            logging.info(f'Request {str(request.object_id)} served from cache')
+                            await request.set_ok(ContentType.IMAGE_URL, *cached)
+                            await request.send_to_client()
+                        continue
+
+                    if not self.generator.distributed and AvgTimeCalc.get_slots(request.executor) == 0:
                         async with request.lock:
                             logging.warning(f'No executors avaible for {request.executor.name}')
                             await request.set_error('No executors avaible')
                             await request.send_to_client()
                         continue
                     
+                    queue = self.generator.get_queue(request.executor)
+                    queue_work = self.generator.queued_work(request.executor)
+                    reason = AdmissionControl.check(request, queue, queue_work)
+                    if reason is not None:
+                        async with request.lock:
+                            await request.set_error(reason)
+                            await request.send_to_client()
+                        continue
+
                     if request.executor == ExecutorType.AUTOMATIC1111:
-                        async with self.generator.automatic1111_queue.lock:
-                            self.generator.add_automatic1111_request(request)
+                        self.generator.add_automatic1111_request(request)
                     elif request.executor == ExecutorType.KANDINSKY:
-                        async with self.generator.kandinsky_queue.lock:
-                            self.generator.add_kandinsky_request(request)
+                        self.generator.add_kandinsky_request(request)
 
                     async with request.lock:
-                        if request.executor == ExecutorType.AUTOMATIC1111:
-                            await request.set_queued((self.generator.automatic1111_queue.general_size,\
-                                self.generator.automatic1111_queue.premium_size))
-                            await request.send_to_client()
-                        elif request.executor == ExecutorType.KANDINSKY:
-                            await request.set_queued((self.generator.kandinsky_queue.general_size,\
-                                self.generator.kandinsky_queue.premium_size))
-                            await request.send_to_client()
+                        await request.set_queued(self.generator.queued_work(request.executor))
+                        await request.send_to_client()
+                    self.generator.schedule_deadline(request)
+                elif message["message_type"] == MessageType.CANCEL.value:
+                    object_id = message.get('object_id')
+                    logging.info(f'Cancel of request:{object_id} from {service.name}')
+                    if not await self.generator.cancel(object_id, service):
+                        logging.warning(f'Request:{object_id} is unknown, already finished or of another service')
         except WebSocketDisconnect:
             logging.warning("Client disconnected")
         finally:
-            await self.disconnect(service)
+            await self.disconnect(websocket, service)
     
+    async def receive_message(self, websocket: WebSocket) -> dict:
+        '''Decodes text or binary JSON frame with the fast codec'''
+        message = await websocket.receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect(message.get('code', 1000))
+        text = message.get('text')
+        return loads(text if text is not None else message['bytes'])
+
     def verify_token(self, websocket: WebSocket, service: str):
         token = websocket.headers.get("authorization")
         if not service in self.services.keys():
@@ -72,27 +119,102 @@ class WebsocketManager():
                 return False
         return True
     
-    async def connect(self, websocket: WebSocket, service: Service):
+    async def connect(self, websocket: WebSocket, service: Service) -> OutboundQueue:
         logging.info(f'New ws connection for service {service.name}')
         await websocket.accept()
-        self.connections[service] = websocket
-
-    async def disconnect(self, service: Service):
-        if service in self.connections.keys():
-            try:
-                await self.connections[service].close(reason="Server forced disconnect")
-                logging.info(f'Closing ws connection for service {service.name}')
-                del self.connections[service]
-            except Exception as e:
-                logging.error(f'Error closing ws connection for service {service.name}: {e}')
-    
-    async def send_message(self, service: Service, json_message):
-        websocket = self.connections.get(service)
-        if websocket is None:
-            raise Exception(f'No websocket connection for service {service.name}')
-        await websocket.send_json(json_message)
+        outbound = OutboundQueue(websocket, service.name, self.on_outbound_close)
+        self.connections.setdefault(service, []).append(outbound)
+        self.outbound_services[outbound] = service
+        # Results produced while service was disconnected go first
+        pending = self.pending.pop(service, None)
+        self.pending_bytes.pop(service, None)
+        if pending:
+            logging.info(f'Sending {len(pending)} buffered results to {service.name}')
+            for json_message, data, labels in pending:
+                outbound.put(json_message, data, labels)
+        return outbound
+
+    def on_outbound_close(self, outbound: OutboundQueue):
+        '''Unregisters connection, its unsent results go to the rest of the pool'''
+        service = self.outbound_services.pop(outbound, None)
+        if service is None:
+            return
+        pool = self.connections.get(service, [])
+        if outbound in pool:
+            pool.remove(outbound)
+        if not pool:
+            self.connections.pop(service, None)
+        for json_message, data, labels in outbound.unsent_results():
+            self.route_message(service, json_message, data, labels)
+        asyncio.get_running_loop().create_task(self.close_websocket(outbound.websocket, service))
+
+    async def close_websocket(self, websocket: WebSocket, service: Service):
+        try:
+            await websocket.close(reason="Server forced disconnect")
+            logging.info(f'Closing ws connection for service {service.name}')
+        except Exception as e:
+            logging.error(f'Error closing ws connection for service {service.name}: {e}')
+
+    async def disconnect(self, websocket: WebSocket, service: Service):
+        for outbound in self.connections.get(service, []):
+            if outbound.websocket is websocket:
+                outbound.close()
+                break
+
+    async def send_message(
+            self,
+            service: Service,
+            json_message,
+            connection: OutboundQueue = None,
+            data: bytes = None,
+            labels: tuple = None
+        ):
+        '''Queues message for the service connection, never waits for the client'''
+        if connection is not None and not connection.closed:
+            connection.put(json_message, data, labels)
+            return
+        self.route_message(service, json_message, data, labels)
+
+    def route_message(self, service: Service, json_message, data: bytes = None, labels: tuple = None):
+        '''Sends to the least loaded connection of the service'''
+        pool = self.connections.get(service)
+        if not pool:
+            # Status updates are stale on reconnect, results are kept
+            if json_message.get('gen_status') in FINAL_STATUSES:
+                self.buffer_message(service, json_message, data, labels)
+            return
+        min(pool, key=len).put(json_message, data, labels)
+
+    def buffer_message(self, service: Service, json_message, data: bytes = None, labels: tuple = None):
+        '''Keeps result for reconnect, oldest results go first over count or bytes limit'''
+        size = self.image_size(json_message, data)
+        if size > self.pending_bytes_limit:
+            logging.warning(f'Result of request:{json_message.get("object_id")} is too large to keep '
+                f'for {service.name}, dropping it')
+            return
+        pending = self.pending.setdefault(service, deque())
+        pending_bytes = self.pending_bytes.get(service, 0)
+        while len(pending) >= self.pending_limit or pending_bytes + size > self.pending_bytes_limit:
+            dropped, dropped_data, _ = pending.popleft()
+            pending_bytes -= self.image_size(dropped, dropped_data)
+            logging.warning(f'Result buffer of {service.name} is full, '
+                f'dropping request:{dropped.get("object_id")}')
+        pending.append((json_message, data, labels))
+        self.pending_bytes[service] = pending_bytes + size
+
+    @staticmethod
+    def image_size(json_message, data: bytes = None) -> int:
+        '''Bytes of image held by message, binary frame or base64 content'''
+        if data is not None:
+            return len(data)
+        result = json_message.get('result')
+        if isinstance(result, dict) and result.get('content_type') == ContentType.BASE64.value:
+            return len(result.get('content') or '')
+        return 0
 
     async def broadcast(self, json_message):
         '''Broadcasts message to all connected clients'''
-        for websocket in self.connections.values():
-            await websocket.send_json(json_message)
\ No newline at end of file
+        # Writers of all connections send it concurrently
+        for pool in self.connections.values():
+            for outbound in pool:
+                outbound.put(json_message)
@@ -0,0 +1,114 @@
+import os
+import asyncio
+import mimetypes
+
+from typing import Tuple, Union
+from email.utils import formatdate
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+from utils.image_store import StoredImage
+
+class ImageResponse(Response):
+    '''Stored image with validators, single byte ranges and zero-copy send.
+
+    Files are sent with the `http.response.zerocopysend` extension when the
+    server offers it, otherwise they are read in chunks off the event loop.
+    '''
+    chunk_size = 65536
+
+    def __init__(self, image: StoredImage, request_headers: Headers, method: str = 'GET') -> None:
+        self.image = image
+        self.send_body = method != 'HEAD'
+        self.background = None
+        self.status_code = 200
+        self.range = None
+
+        self.raw_headers = [
+            (b'etag', image.etag.encode()),
+            (b'last-modified', formatdate(image.modified, usegmt=True).encode()),
+            (b'accept-ranges', b'bytes'),
+            (b'cache-control', b'public, max-age=31536000, immutable')
+        ]
+        if self.not_modified(request_headers.get('if-none-match')):
+            self.status_code = 304
+            return
+
+        content_range = self.parse_range(request_headers)
+        if content_range == 'invalid':
+            self.status_code = 416
+            self.raw_headers.append((b'content-range', f'bytes */{image.size}'.encode()))
+            return
+        if content_range is not None:
+            self.status_code = 206
+            self.range = content_range
+            start, end = content_range
+            self.raw_headers.append((b'content-range', f'bytes {start}-{end - 1}/{image.size}'.encode()))
+        else:
+            self.range = (0, image.size)
+        media_type = mimetypes.guess_type(image.file_name)[0] or 'image/jpeg'
+        self.raw_headers.append((b'content-type', media_type.encode()))
+        self.raw_headers.append((b'content-length', str(self.range[1] - self.range[0]).encode()))
+
+    def not_modified(self, if_none_match: Union[str, None]) -> bool:
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or self.image.etag in tags or f'W/{self.image.etag}' in tags
+
+    def parse_range(self, request_headers: Headers) -> Union[Tuple[int, int], str, None]:
+        '''Single `bytes` range as (start, end), `invalid` if it cannot be served'''
+        value = request_headers.get('range')
+        if not value or not value.startswith('bytes=') or ',' in value:
+            # Several ranges are answered with the whole image
+            return None
+        if_range = request_headers.get('if-range')
+        if if_range is not None and if_range != self.image.etag:
+            return None
+        size = self.image.size
+        first, _, last = value[6:].strip().partition('-')
+        try:
+            if not first:
+                start, end = max(size - int(last), 0), size
+            else:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+        except ValueError:
+            return None
+        if start >= size or start >= end:
+            return 'invalid'
+        return start, end
+
+    async def __call__(self, scope, receive, send) -> None:
+        if self.status_code not in (200, 206) or not self.send_body:
+            await self.send_start(send)
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        start, end = self.range
+        if self.image.data is not None:
+            await self.send_start(send)
+            await send({'type': 'http.response.body', 'body': self.image.data[start:end]})
+            return
+
+        loop = asyncio.get_running_loop()
+        with open(self.image.path, 'rb') as file:
+            await self.send_start(send)
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.zerocopysend', 'file': file.fileno(),\
+                    'offset': start, 'count': end - start})
+                return
+            position = start
+            while position < end:
+                chunk = await loop.run_in_executor(None, os.pread, file.fileno(),\
+                    min(self.chunk_size, end - position), position)
+                if not chunk:
+                    break
+                position += len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': position < end})
+            if position < end:
+                # File shrank while sending
+                await send({'type': 'http.response.body', 'body': b''})
+
+    async def send_start(self, send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
@@ -0,0 +1,145 @@
+import struct
+import asyncio
+import logging
+
+from time import perf_counter
+
+from os import getenv
+from typing import Dict, Deque, List, Callable, Tuple
+from collections import deque
+from fastapi import WebSocket
+
+from enums import GenStatus
+from utils.json_codec import dumps
+from utils.metrics import Metrics
+
+FINAL_STATUSES = (GenStatus.OK.value, GenStatus.ERROR.value, GenStatus.CANCELLED.value)
+
+def pack_frame(header: dict, data: bytes) -> bytes:
+    '''Binary frame: 4 byte big-endian header length, JSON header, data'''
+    header = dumps(header)
+    return struct.pack('>I', len(header)) + header + data
+
+class OutboundQueue():
+    '''Outbound messages of one websocket connection, sent by its own writer task.
+
+    `put` never waits for the client. While the client is behind, a newer status
+    of a request replaces its unsent one. When the buffer is full, status
+    updates are dropped first (`drop_status` policy) and the connection is
+    closed if only results are left, `disconnect` policy closes it right away.
+    '''
+    websocket: WebSocket
+    messages: Deque[list]
+    '''[object_id, message, data, labels] entries in send order, data is sent as binary frame,
+    send time is observed with request metric labels if there are any'''
+    statuses: Dict[str, list]
+    '''Unsent status entries by object_id'''
+    on_close: Callable[['OutboundQueue'], None]
+
+    limit = int(getenv('WS_SEND_BUFFER', 1000))
+    overflow = getenv('WS_OVERFLOW', 'drop_status')
+    send_timeout = float(getenv('WS_SEND_TIMEOUT', 10))
+
+    def __init__(
+            self,
+            websocket: WebSocket,
+            name: str,
+            on_close: Callable[['OutboundQueue'], None]
+        ) -> None:
+        if self.overflow not in ('drop_status', 'disconnect'):
+            raise ValueError(f'Unknown websocket overflow policy `{self.overflow}`')
+        self.websocket = websocket
+        self.name = name
+        self.on_close = on_close
+        self.messages = deque()
+        self.statuses = {}
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.writer = asyncio.get_running_loop().create_task(self.writer_loop())
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def put(self, json_message: dict, data: bytes = None, labels: tuple = None) -> None:
+        if self.closed:
+            return
+        object_id = json_message.get('object_id')
+        final = json_message.get('gen_status') in FINAL_STATUSES
+
+        entry = self.statuses.get(object_id)
+        if entry is not None:
+            # Client has not got the previous status yet, it is replaced in place
+            entry[1] = json_message
+            entry[2] = data
+            entry[3] = labels
+            if final:
+                del self.statuses[object_id]
+            return
+
+        entry = [object_id, json_message, data, labels]
+        if len(self.messages) >= self.limit and not self.make_room(final):
+            if final:
+                # Kept with the unsent results, they are rerouted on close
+                self.messages.append(entry)
+                logging.warning(f'Send buffer of {self.name} is full, closing connection')
+                self.close()
+            return
+        self.messages.append(entry)
+        if not final and object_id is not None:
+            self.statuses[object_id] = entry
+        self.ready.set()
+
+    def make_room(self, final: bool) -> bool:
+        '''Frees a place for new message, False if there is none'''
+        if self.overflow == 'drop_status':
+            if not final:
+                logging.debug(f'Send buffer of {self.name} is full, dropping status')
+                return False
+            # Oldest unsent status gives its place to the result
+            for object_id, entry in self.statuses.items():
+                self.messages.remove(entry)
+                del self.statuses[object_id]
+                return True
+            return False
+        if not final:
+            logging.warning(f'Send buffer of {self.name} is full, closing connection')
+            self.close()
+        return False
+
+    async def writer_loop(self) -> None:
+        while True:
+            await self.ready.wait()
+            while self.messages:
+                object_id, json_message, data, labels = entry = self.messages[0]
+                if self.statuses.get(object_id) is entry:
+                    del self.statuses[object_id]
+                time_start = perf_counter()
+                try:
+                    if data is None:
+                        send = self.websocket.send_text(dumps(json_message).decode())
+                    else:
+                        send = self.websocket.send_bytes(pack_frame(json_message, data))
+                    await asyncio.wait_for(send, self.send_timeout)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.warning(f'Cannot send to {self.name}, closing connection: [{type(e)}] {e}')
+                    self.close()
+                    return
+                self.messages.popleft()
+                if labels is not None:
+                    Metrics.ws_send.observe(perf_counter() - time_start, *labels)
+            self.ready.clear()
+
+    def close(self) -> None:
+        '''Stops writer, unsent messages stay in `messages`'''
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        self.on_close(self)
+
+    def unsent_results(self) -> List[Tuple[dict, bytes, tuple]]:
+        return [(json_message, data, labels) for _, json_message, data, labels in self.messages\
+            if json_message.get('gen_status') in FINAL_STATUSES]
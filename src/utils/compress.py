@@ -1,8 +1,92 @@
 import io
+import os
+import asyncio
+import logging
+import multiprocessing
+
 from PIL import Image
+from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 
-def compress_image(image_bytes: bytes) -> bytes:
+def compress_image(image_bytes: bytes, options: dict = None) -> bytes:
+    '''Re-encodes image, `options` are format, quality, progressive and max_size'''
+    options = options or {}
     image = Image.open(io.BytesIO(image_bytes))
+    max_size = options.get('max_size')
+    if max_size:
+        # Only shrinks, aspect ratio is kept
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+    image_format = options.get('format', 'jpeg')
+    kwargs = {}
+    if image_format == 'jpeg':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        kwargs['quality'] = options.get('quality', 75)
+        if options.get('progressive'):
+            kwargs['progressive'] = True
+            kwargs['optimize'] = True
+    elif image_format == 'webp':
+        kwargs['quality'] = options.get('quality', 75)
     compressed_image = io.BytesIO()
-    image.save(compressed_image, format='jpeg')
-    return compressed_image.getvalue()
\ No newline at end of file
+    image.save(compressed_image, format=image_format, **kwargs)
+    return compressed_image.getvalue()
+
+def compress_shared_image(name: str, size: int, options: dict = None) -> bytes:
+    '''Worker side: compresses image placed in shared memory block'''
+    shm = SharedMemory(name=name)
+    try:
+        buffer = shm.buf[:size]
+        try:
+            return compress_image(buffer, options)
+        finally:
+            buffer.release()
+    finally:
+        shm.close()
+
+class ImageCompressor():
+    '''Runs image compression in worker processes, off the event loop'''
+    pool: ProcessPoolExecutor = None
+    workers: int = int(os.getenv('IMAGE_WORKERS', os.cpu_count() or 1))
+
+    @classmethod
+    def init(cls, workers: int = None) -> None:
+        if workers is not None:
+            cls.workers = workers
+        if cls.workers > 0:
+            # Workers start lazily, after database and S3 clients started their
+            # threads, forking the process then may deadlock them
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            cls.pool = ProcessPoolExecutor(max_workers=cls.workers,\
+                mp_context=multiprocessing.get_context(start_method))
+        logging.info(f'Image compressor loaded with {cls.workers} workers')
+
+    @classmethod
+    def close(cls) -> None:
+        if cls.pool is not None:
+            cls.pool.shutdown(wait=True, cancel_futures=True)
+            cls.pool = None
+
+    @classmethod
+    async def compress(cls, image_bytes: bytes, options: dict = None) -> bytes:
+        return (await cls.encode(image_bytes, [options]))[0]
+
+    @classmethod
+    async def encode(cls, image_bytes: bytes, outputs: List[dict]) -> List[bytes]:
+        '''Encodes image once per options of `outputs`, in parallel'''
+        loop = asyncio.get_running_loop()
+        if cls.pool is None:
+            # No worker processes, at least keep the event loop free
+            return await asyncio.gather(*[loop.run_in_executor(None, compress_image,\
+                image_bytes, options) for options in outputs])
+
+        # Image is handed over through shared memory instead of pickling it,
+        # all outputs read the same block
+        shm = SharedMemory(create=True, size=max(len(image_bytes), 1))
+        try:
+            shm.buf[:len(image_bytes)] = image_bytes
+            return await asyncio.gather(*[loop.run_in_executor(cls.pool, compress_shared_image,\
+                shm.name, len(image_bytes), options) for options in outputs])
+        finally:
+            shm.close()
+            shm.unlink()
@@ -2,10 +2,17 @@ import asyncio
 import logging
 
 from os import getenv
+from typing import Dict, List, Tuple
 from bson.objectid import ObjectId
+from time import perf_counter
+from datetime import datetime, timedelta
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 
 import motor.motor_asyncio
-from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorClient
+
+from .metrics import Metrics
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorClient, AsyncIOMotorCursor
 
 from asyncio import AbstractEventLoop
 
@@ -20,6 +27,20 @@ class DevoidDatabase():
     '''Database instance'''
     __client: AsyncIOMotorClient
     '''Client instance'''    
+    __pending: Dict[ObjectId, dict] = {}
+    '''Request fields waiting to be written, coalesced by id'''
+    __flush_event: asyncio.Event = None
+    '''Set when pending writes reach flush size'''
+    __writer: asyncio.Task = None
+    '''Write-behind task'''
+    __closing: bool = False
+    '''Set by close, writer stops after its current flush'''
+    flush_size: int = int(getenv('DB_FLUSH_SIZE', 100))
+    '''Pending requests count that triggers flush'''
+    flush_interval: float = float(getenv('DB_FLUSH_INTERVAL', 1.0))
+    '''Max seconds a write stays pending'''
+    retry_codes = {11000}
+    '''Write error codes worth another try, duplicate key is a concurrent upsert'''
     
     def __new__(cls):
         '''Singleton constructor'''
@@ -50,6 +71,231 @@ class DevoidDatabase():
         except Exception as e:
             logging.error(e)
     
+    @classmethod
+    def write_request(cls, id: ObjectId, fields: dict) -> None:
+        '''Queues request fields for write-behind, never waits for MongoDB'''
+        pending = cls.__pending.get(id)
+        if pending is None:
+            cls.__pending[id] = dict(fields)
+        else:
+            # Later state transitions overwrite earlier ones
+            pending.update(fields)
+        if len(cls.__pending) >= cls.flush_size and cls.__flush_event is not None:
+            cls.__flush_event.set()
+
+    @classmethod
+    def start_writer(cls, loop: AbstractEventLoop = None) -> None:
+        '''Starts write-behind task'''
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        cls.__flush_event = asyncio.Event()
+        cls.__closing = False
+        cls.__writer = loop.create_task(cls.__writer_loop())
+
+    @classmethod
+    async def __writer_loop(cls) -> None:
+        while not cls.__closing:
+            try:
+                await asyncio.wait_for(cls.__flush_event.wait(), cls.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            cls.__flush_event.clear()
+            await cls.flush()
+
+    @classmethod
+    async def flush(cls) -> None:
+        '''Writes all pending request fields with one bulk write'''
+        if not cls.__pending:
+            return
+        batch, cls.__pending = cls.__pending, {}
+        operations = [UpdateOne({'_id': id}, {'$set': fields}, upsert=True)\
+            for id, fields in batch.items()]
+        try:
+            time_start = perf_counter()
+            await cls.__database.requests.bulk_write(operations, ordered=False)
+            Metrics.mongo_write.observe(perf_counter() - time_start)
+            logging.debug(f'Flushed {len(operations)} requests to MongoDB')
+        except BulkWriteError as e:
+            # Unordered write, only the failed operations were not applied
+            ids = list(batch.keys())
+            retry = {}
+            for error in e.details.get('writeErrors', []):
+                id = ids[error['index']]
+                if error.get('code') in cls.retry_codes:
+                    retry[id] = batch[id]
+                else:
+                    logging.error(f'Cannot write request:{str(id)} to MongoDB, dropping it: {error.get("errmsg")}')
+            cls.__put_back(retry)
+        except Exception as e:
+            logging.error(f'Cannot flush {len(operations)} requests to MongoDB: {e}')
+            cls.__put_back(batch)
+        except BaseException:
+            # Cancelled mid write, batch may not be written
+            cls.__put_back(batch)
+            raise
+
+    @classmethod
+    def __put_back(cls, batch: Dict[ObjectId, dict]) -> None:
+        '''Returns unwritten batch to pending writes, newer fields win'''
+        for id, fields in batch.items():
+            fields.update(cls.__pending.get(id, {}))
+            cls.__pending[id] = fields
+
+    @classmethod
+    async def close(cls) -> None:
+        '''Stops write-behind task after its current flush and flushes pending writes'''
+        if cls.__writer is not None:
+            cls.__closing = True
+            cls.__flush_event.set()
+            await cls.__writer
+            cls.__writer = None
+        await cls.flush()
+
+    @classmethod
+    async def create_indexes(cls, result_cache_ttl: float) -> None:
+        '''Creates indexes used by generator'''
+        try:
+            await cls.__database.requests.create_index([('gen_status', 1), ('_id', 1)])
+            await cls.__database.queue.create_index([('exec_type', 1), ('premium', 1),\
+                ('status', 1), ('order', 1)])
+            await cls.__database.queue.create_index([('status', 1), ('lease_until', 1)])
+            await cls.__database.queue_messages.create_index([('gateway', 1), ('_id', 1)])
+            # Messages of a gateway that never came back
+            await cls.__database.queue_messages.create_index('created_date', expireAfterSeconds=86400)
+            await cls.__database.results_cache.create_index('key', unique=True)
+            if result_cache_ttl > 0:
+                await cls.__database.results_cache.create_index('created_date',\
+                    expireAfterSeconds=int(result_cache_ttl))
+        except Exception as e:
+            logging.error(f'Cannot create MongoDB indexes: {e}')
+
+    @classmethod
+    async def find_cached_result(cls, key: str) -> dict:
+        '''Finds cached result by cache key'''
+        return await cls.__database.results_cache.find_one({'key': key})
+
+    @classmethod
+    async def cache_result(
+            cls,
+            key: str,
+            image_url: str,
+            file_name: str,
+            created_at: float,
+            variants: dict = None
+        ) -> None:
+        '''Saves result to cache'''
+        try:
+            await cls.__database.results_cache.update_one({'key': key}, {'$set': {
+                'image_url': image_url,
+                'file_name': file_name,
+                'variants': variants or None,
+                'created_at': created_at,
+                'created_date': datetime.utcfromtimestamp(created_at)
+            }}, upsert=True)
+        except Exception as e:
+            logging.error(f'Cannot save result to cache: {e}')
+
+    @classmethod
+    def find_unfinished_requests(cls, batch_size: int = 1000) -> AsyncIOMotorCursor:
+        '''Streams queued and generating requests in creation order'''
+        return cls.__database.requests.find({'gen_status': {'$in': ['queued', 'generating']}},\
+            sort=[('_id', 1)], batch_size=batch_size)
+
+    @classmethod
+    async def enqueue_request(cls, document: dict) -> None:
+        '''Adds request document to shared queue'''
+        await cls.__database.queue.insert_one(document)
+
+    @classmethod
+    async def claim_request(cls, exec_type: str, premium: bool, owner: str, lease: float) -> dict:
+        '''Atomically leases the oldest queued (or lease expired) request'''
+        now = datetime.utcnow()
+        return await cls.__database.queue.find_one_and_update({
+                'exec_type': exec_type,
+                'premium': premium,
+                'cancelled': {'$ne': True},
+                '$or': [
+                    {'status': 'queued'},
+                    {'status': 'leased', 'lease_until': {'$lt': now}}
+                ]
+            }, {'$set': {
+                'status': 'leased',
+                'owner': owner,
+                'lease_until': now + timedelta(seconds=lease)
+            }}, sort=[('order', 1)], return_document=ReturnDocument.AFTER)
+
+    @classmethod
+    async def renew_leases(cls, ids: List[ObjectId], owner: str, lease: float) -> None:
+        '''Heartbeat of leased requests'''
+        await cls.__database.queue.update_many({'_id': {'$in': ids}, 'owner': owner},\
+            {'$set': {'lease_until': datetime.utcnow() + timedelta(seconds=lease)}})
+
+    @classmethod
+    async def release_request(cls, id: ObjectId, owner: str, retries: int) -> None:
+        '''Returns leased request to shared queue keeping its order'''
+        await cls.__database.queue.update_one({'_id': id, 'owner': owner}, {'$set': {
+            'status': 'queued',
+            'owner': None,
+            'lease_until': None,
+            'retries': retries
+        }})
+
+    @classmethod
+    async def complete_request(cls, id: ObjectId, owner: str) -> None:
+        '''Removes processed request from shared queue'''
+        await cls.__database.queue.delete_one({'_id': id, 'owner': owner})
+
+    @classmethod
+    async def cancel_queued_request(cls, id: ObjectId, service: str) -> bool:
+        '''Removes queued request or flags leased one for its owner, False if not queued for service'''
+        return await cls.remove_queued_request(id, service) or await cls.flag_queued_request(id, service)
+
+    @classmethod
+    async def remove_queued_request(cls, id: ObjectId, service: str) -> bool:
+        '''Removes request nobody claimed yet'''
+        result = await cls.__database.queue.delete_one({'_id': id, 'request.service': service, 'status': 'queued'})
+        return result.deleted_count > 0
+
+    @classmethod
+    async def flag_queued_request(cls, id: ObjectId, service: str) -> bool:
+        '''Flags claimed request as cancelled for its owner'''
+        result = await cls.__database.queue.update_one({'_id': id, 'request.service': service},\
+            {'$set': {'cancelled': True}})
+        return result.matched_count > 0
+
+    @classmethod
+    async def find_cancelled_requests(cls, ids: List[ObjectId], owner: str) -> List[ObjectId]:
+        '''Leased requests of owner cancelled by other processes'''
+        return [document['_id'] async for document in cls.__database.queue.find(\
+            {'_id': {'$in': ids}, 'owner': owner, 'cancelled': True}, {'_id': 1})]
+
+    @classmethod
+    async def relay_message(cls, document: dict) -> None:
+        '''Stores request state for the gateway the client is connected to'''
+        await cls.__database.queue_messages.insert_one(document)
+
+    @classmethod
+    async def take_relayed_message(cls, gateway: str) -> dict:
+        '''Removes and returns the oldest message for gateway, None if there is none'''
+        return await cls.__database.queue_messages.find_one_and_delete({'gateway': gateway},\
+            sort=[('_id', 1)])
+
+    @classmethod
+    async def queue_stats(cls, exec_type: str) -> Dict[Tuple[bool, str], Tuple[int, float]]:
+        '''Queued requests count and work by premium and service'''
+        stats = {}
+        async for group in cls.__database.queue.aggregate([
+                {'$match': {'exec_type': exec_type, 'status': 'queued'}},
+                {'$group': {
+                    '_id': {'premium': '$premium', 'service': '$request.service'},
+                    'count': {'$sum': 1},
+                    'work': {'$sum': '$work'}
+                }}
+            ]):
+            key = (bool(group['_id']['premium']), group['_id']['service'])
+            stats[key] = (group['count'], group['work'])
+        return stats
+
     @classmethod
     def get_loop(cls) -> AbstractEventLoop:
         '''Returns running event loop'''
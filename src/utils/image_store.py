@@ -0,0 +1,124 @@
+import os
+import asyncio
+import logging
+import tempfile
+
+from hashlib import md5
+from time import time
+from typing import Union
+from collections import OrderedDict
+
+class StoredImage():
+    '''Image found in the store, `data` is set for images served from memory'''
+    __slots__ = ('file_name', 'path', 'size', 'modified', 'data')
+
+    def __init__(
+            self,
+            file_name: str,
+            path: str,
+            size: int,
+            modified: float,
+            data: bytes = None
+        ) -> None:
+        self.file_name = file_name
+        self.path = path
+        self.size = size
+        self.modified = modified
+        self.data = data
+
+    @property
+    def etag(self) -> str:
+        # Names are request ids, content of a name never changes
+        return f'"{os.path.splitext(self.file_name)[0]}-{self.size:x}"'
+
+class ImageStore():
+    '''Local copies of generated images under `IMAGES_PATH`.
+
+    Files are spread over two levels of directories by hash of the name and
+    written atomically (temp file, then rename), so a reader never sees a
+    partial image. The most recently stored images are also kept in memory
+    up to `IMAGE_CACHE_SIZE` bytes, clients usually fetch them right after
+    completion.
+    '''
+    path: str = os.getenv('IMAGES_PATH') or 'gens/'
+    cache_size: int = int(os.getenv('IMAGE_CACHE_SIZE', 67108864))
+    '''Max bytes of images kept in memory, 0 disables the cache'''
+    cache: 'OrderedDict[str, StoredImage]' = OrderedDict()
+    cache_bytes: int = 0
+
+    @staticmethod
+    def valid_name(file_name: str) -> bool:
+        return bool(file_name) and not file_name.startswith('.')\
+            and '/' not in file_name and '\\' not in file_name
+
+    @classmethod
+    def file_path(cls, file_name: str) -> str:
+        digest = md5(file_name.encode()).hexdigest()
+        return os.path.join(cls.path, digest[:2], digest[2:4], file_name)
+
+    @classmethod
+    def write(cls, image_bytes: bytes, file_name: str) -> None:
+        path = cls.file_path(file_name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                os.fchmod(file.fileno(), 0o644)
+                file.write(image_bytes)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    async def save(cls, image_bytes: bytes, file_name: str) -> None:
+        cls.remember(image_bytes, file_name)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, cls.write, image_bytes, file_name)
+        except Exception as e:
+            logging.error(f'Cannot save image {file_name} locally: {e}')
+
+    @classmethod
+    def put(cls, image_bytes: bytes, file_name: str) -> None:
+        '''Stores image in background, it is served from memory until written'''
+        asyncio.get_running_loop().create_task(cls.save(image_bytes, file_name))
+
+    @classmethod
+    def remember(cls, image_bytes: bytes, file_name: str) -> None:
+        if len(image_bytes) > cls.cache_size:
+            return
+        cls.forget(file_name)
+        cls.cache[file_name] = StoredImage(file_name, cls.file_path(file_name),\
+            len(image_bytes), time(), image_bytes)
+        cls.cache_bytes += len(image_bytes)
+        while cls.cache_bytes > cls.cache_size:
+            _, image = cls.cache.popitem(last=False)
+            cls.cache_bytes -= image.size
+
+    @classmethod
+    def forget(cls, file_name: str) -> None:
+        image = cls.cache.pop(file_name, None)
+        if image is not None:
+            cls.cache_bytes -= image.size
+
+    @classmethod
+    def get(cls, file_name: str) -> Union[StoredImage, None]:
+        '''Finds image in memory, then on disk, None if there is no such image'''
+        if not cls.valid_name(file_name):
+            return None
+        image = cls.cache.get(file_name)
+        if image is not None:
+            cls.cache.move_to_end(file_name)
+            return image
+        # Flat layout of older versions is still served
+        for path in (cls.file_path(file_name), os.path.join(cls.path, file_name)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            return StoredImage(file_name, path, stat.st_size, stat.st_mtime)
+        return None
@@ -0,0 +1,45 @@
+import json
+
+from uuid import uuid4
+from typing import Any, List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class Raw():
+    '''Already encoded JSON value, embedded into output as is'''
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+# Placeholder that encodes to itself in both encoders
+RAW_TOKEN = f'@raw-{uuid4().hex}-'
+
+def loads(data: Any) -> Any:
+    '''Decodes str or bytes'''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def encode(obj: Any, default) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, default=default, separators=(',', ':'), ensure_ascii=False).encode()
+
+def dumps(obj: Any) -> bytes:
+    '''Encodes to compact UTF-8 JSON, `Raw` values are spliced in without re-encoding'''
+    raws: List[bytes] = []
+
+    def default(value):
+        if isinstance(value, Raw):
+            raws.append(value.data)
+            return f'{RAW_TOKEN}{len(raws) - 1}'
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    data = encode(obj, default)
+    for index, raw in enumerate(raws):
+        data = data.replace(f'"{RAW_TOKEN}{index}"'.encode(), raw, 1)
+    return data
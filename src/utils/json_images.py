@@ -0,0 +1,134 @@
+import re
+import binascii
+
+from typing import List, Union
+
+STRUCTURE = re.compile(rb'["{}\[\],:]')
+STRING_END = re.compile(rb'["\\]')
+# Escapes possible inside base64 JSON strings
+ESCAPES = {
+    ord('/'): b'/',
+    ord('n'): b'',
+    ord('r'): b'',
+    ord('t'): b''
+}
+
+class JsonImagesDecoder():
+    '''Incrementally decodes base64 strings of top-level `key` array from JSON chunks.
+
+    Everything else in the document is scanned and skipped, never materialised,
+    and every image is decoded into its own buffer while its string is still arriving.
+    '''
+    key: bytes
+    images: List[bytes]
+
+    def __init__(self, key: str = 'images') -> None:
+        self.key = key.encode()
+        self.images = []
+
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.current_key = None
+        self.in_images = False
+
+        # Current string buffers, only one of them is used at a time
+        self.key_buffer: Union[bytearray, None] = None
+        self.image: Union[bytearray, None] = None
+        self.pending = bytearray()
+        self.header = False
+
+    def feed(self, chunk: bytes) -> None:
+        position = 0
+        size = len(chunk)
+        while position < size:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.string_data(ESCAPES.get(chunk[position], chunk[position:position + 1]))
+                    position += 1
+                    continue
+                match = STRING_END.search(chunk, position)
+                end = size if match is None else match.start()
+                if end > position:
+                    self.string_data(chunk[position:end])
+                if match is None:
+                    break
+                position = end + 1
+                if chunk[end] == ord('\\'):
+                    self.escape = True
+                else:
+                    self.in_string = False
+                    self.end_string()
+                continue
+
+            match = STRUCTURE.search(chunk, position)
+            if match is None:
+                break
+            position = match.end()
+            char = chunk[match.start()]
+            if char == ord('"'):
+                self.start_string()
+            elif char in b'{[':
+                self.depth += 1
+                if self.depth == 1:
+                    self.expect_key = char == ord('{')
+                elif self.depth == 2 and char == ord('[') and self.current_key == self.key:
+                    self.in_images = True
+            elif char in b'}]':
+                if self.depth == 2:
+                    self.in_images = False
+                self.depth -= 1
+            elif self.depth == 1:
+                self.expect_key = char == ord(',')
+
+    def start_string(self) -> None:
+        self.in_string = True
+        if self.depth == 1 and self.expect_key:
+            self.key_buffer = bytearray()
+        elif self.depth == 2 and self.in_images:
+            self.image = bytearray()
+            self.pending = bytearray()
+            self.header = True
+
+    def string_data(self, data: bytes) -> None:
+        if self.key_buffer is not None:
+            self.key_buffer += data
+        elif self.image is not None:
+            self.pending += data
+            self.decode()
+
+    def decode(self, final: bool = False) -> None:
+        if self.header:
+            # Optional `data:image/png;base64,` prefix
+            if len(self.pending) < 5 and not final:
+                return
+            if self.pending.startswith(b'data:'):
+                comma = self.pending.find(b',')
+                if comma < 0:
+                    if not final:
+                        return
+                    raise ValueError('Invalid image data URI')
+                del self.pending[:comma + 1]
+            self.header = False
+
+        size = len(self.pending) if final else len(self.pending) // 4 * 4
+        if size:
+            self.image += binascii.a2b_base64(self.pending[:size])
+            del self.pending[:size]
+
+    def end_string(self) -> None:
+        if self.key_buffer is not None:
+            self.current_key = bytes(self.key_buffer)
+            self.key_buffer = None
+        elif self.image is not None:
+            self.decode(final=True)
+            self.images.append(bytes(self.image))
+            self.image = None
+
+    def close(self) -> List[bytes]:
+        '''Returns decoded images, document must be complete'''
+        if self.depth != 0 or self.in_string:
+            raise ValueError('Incomplete JSON response')
+        return self.images
@@ -0,0 +1,139 @@
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+REQUEST_LABELS = ('executor', 'exec_type', 'gen_type', 'premium')
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+class Metric():
+    '''Base metric in Prometheus text format'''
+    kind: str = 'untyped'
+    name: str
+    documentation: str
+    labelnames: Tuple[str, ...]
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError('`samples` not implemented')
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}',\
+            f'# TYPE {self.name} {self.kind}', *self.samples()]
+
+class Counter(Metric):
+    kind = 'counter'
+    values: Dict[Tuple, float]
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {value}'\
+            for labels, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels) -> None:
+        self.values[labels] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+    buckets: Tuple[float, ...]
+    values: Dict[Tuple, list]
+    '''labels -> [bucket counts..., sum, count]'''
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = None
+        ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.values = {}
+
+    def observe(self, value: float, *labels) -> None:
+        state = self.values.get(labels)
+        if state is None:
+            # Last bucket is +Inf
+            state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        state[bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), state):
+                cumulative += count
+                le = 'le="' + str(bound) + '"'
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {state[-2]}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {state[-1]}')
+        return lines
+
+class Metrics():
+    '''Generator metrics, recorded in place and rendered on `/metrics`'''
+    queue_wait = Histogram('devoid_queue_wait_seconds',\
+        'Time request spent in queue', REQUEST_LABELS)
+    generation = Histogram('devoid_generation_seconds',\
+        'Backend generation time', REQUEST_LABELS)
+    compression = Histogram('devoid_compression_seconds',\
+        'Image compression time', REQUEST_LABELS)
+    upload = Histogram('devoid_s3_upload_seconds',\
+        'S3 upload time', REQUEST_LABELS)
+    mongo_write = Histogram('devoid_mongo_write_seconds',\
+        'MongoDB bulk write time')
+    latency = Histogram('devoid_request_latency_seconds',\
+        'Time from queueing to result', REQUEST_LABELS)
+    ws_send = Histogram('devoid_ws_send_seconds',\
+        'WebSocket send time', REQUEST_LABELS)
+
+    queue_depth = Gauge('devoid_queue_depth',\
+        'Queued requests', ('exec_type', 'premium'))
+    alive_executors = Gauge('devoid_alive_executors',\
+        'Alive executors', ('exec_type',))
+
+    errors = Counter('devoid_errors_total',\
+        'Failed requests', (*REQUEST_LABELS, 'stage'))
+    rejected = Counter('devoid_rejected_total',\
+        'Requests rejected or shed by admission control', ('exec_type', 'service', 'premium', 'reason'))
+    cancelled = Counter('devoid_cancelled_total',\
+        'Cancelled requests', ('exec_type', 'service', 'stage'))
+    executor_flaps = Counter('devoid_executor_flaps_total',\
+        'Executor alive state changes', ('executor', 'exec_type', 'state'))
+
+    @staticmethod
+    def request_labels(request) -> Tuple[str, str, str, str]:
+        return (request.executor_name or '', request.executor.value,\
+            request.gen_type.value, '1' if request.premium else '0')
+
+    @classmethod
+    def render(cls) -> str:
+        lines = []
+        for metric in vars(cls).values():
+            if isinstance(metric, Metric):
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,118 @@
+import os
+import shutil
+import logging
+import tempfile
+
+from hashlib import sha256
+from typing import Any, Dict
+
+class SpilledBlob():
+    '''Stands for a payload string moved to disk'''
+    __slots__ = ('digest', 'size')
+
+    def __init__(self, digest: str, size: int) -> None:
+        self.digest = digest
+        self.size = size
+
+class PayloadStore():
+    '''Content-addressed temp store for large payload strings of queued requests.
+
+    Strings of at least `threshold` characters (base64 init images, masks) are
+    written once per content and replaced by `SpilledBlob`, so a queued request
+    keeps only its small fields in memory. Files are reference counted between
+    requests with the same blob and the whole store is removed on close.
+    '''
+    threshold: int = int(os.getenv('PAYLOAD_SPILL_SIZE', 262144))
+    '''Min string length to spill, 0 disables spilling'''
+    path: str = None
+    refs: Dict[str, int] = {}
+
+    @classmethod
+    def init(cls, path: str = None) -> None:
+        if cls.threshold <= 0:
+            return
+        if path is None:
+            path = os.getenv('PAYLOAD_SPILL_PATH') or None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        cls.path = tempfile.mkdtemp(prefix='devoid-spill-', dir=path)
+        logging.info(f'Spilling large payloads to {cls.path}')
+
+    @classmethod
+    def close(cls) -> None:
+        if cls.path is not None:
+            shutil.rmtree(cls.path, ignore_errors=True)
+            cls.path = None
+            cls.refs = {}
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls.path is not None
+
+    @classmethod
+    def file_path(cls, digest: str) -> str:
+        return os.path.join(cls.path, digest)
+
+    @classmethod
+    def needs_spill(cls, value: Any) -> bool:
+        if isinstance(value, dict):
+            return any(cls.needs_spill(item) for item in value.values())
+        if isinstance(value, list):
+            return any(cls.needs_spill(item) for item in value)
+        return isinstance(value, str) and len(value) >= cls.threshold
+
+    @classmethod
+    def spill(cls, value: Any) -> Any:
+        '''Returns value with large strings replaced by `SpilledBlob`'''
+        if isinstance(value, dict):
+            return {key: cls.spill(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [cls.spill(item) for item in value]
+        if isinstance(value, str) and len(value) >= cls.threshold:
+            data = value.encode()
+            digest = sha256(data).hexdigest()
+            if not cls.refs.get(digest):
+                with open(cls.file_path(digest), 'wb') as file:
+                    file.write(data)
+            cls.refs[digest] = cls.refs.get(digest, 0) + 1
+            return SpilledBlob(digest, len(value))
+        return value
+
+    @classmethod
+    def load(cls, value: Any, release: bool = True) -> Any:
+        '''Returns value with spilled strings read back, `release` drops the references'''
+        if isinstance(value, dict):
+            return {key: cls.load(item, release) for key, item in value.items()}
+        if isinstance(value, list):
+            return [cls.load(item, release) for item in value]
+        if isinstance(value, SpilledBlob):
+            with open(cls.file_path(value.digest), 'rb') as file:
+                data = file.read().decode()
+            if release:
+                cls.release(value.digest)
+            return data
+        return value
+
+    @classmethod
+    def discard(cls, value: Any) -> None:
+        '''Drops references of spilled strings without reading them'''
+        if isinstance(value, dict):
+            for item in value.values():
+                cls.discard(item)
+        elif isinstance(value, list):
+            for item in value:
+                cls.discard(item)
+        elif isinstance(value, SpilledBlob):
+            cls.release(value.digest)
+
+    @classmethod
+    def release(cls, digest: str) -> None:
+        refs = cls.refs.get(digest, 0) - 1
+        if refs > 0:
+            cls.refs[digest] = refs
+            return
+        cls.refs.pop(digest, None)
+        try:
+            os.remove(cls.file_path(digest))
+        except OSError as e:
+            logging.error(f'Cannot remove spilled payload {digest}: {e}')
@@ -1,20 +1,29 @@
 import os
-import logging 
-import aioboto3 
+import asyncio
+import logging
+import aioboto3
 
-from .compress import compress_image
+from contextlib import AsyncExitStack
+from botocore.config import Config
 
 class Storage():
-    connected: bool
-    resource = None
+    connected: bool = False
+    client = None
     s3_session: aioboto3.Session
-    
+    exit_stack: AsyncExitStack
+    upload_slots: asyncio.Semaphore
+
+    max_connections = int(os.getenv('S3_MAX_CONNECTIONS', 20))
+    upload_concurrency = int(os.getenv('S3_UPLOAD_CONCURRENCY', 8))
+    upload_retries = int(os.getenv('S3_UPLOAD_RETRIES', 3))
+    retry_backoff = float(os.getenv('S3_RETRY_BACKOFF', 0.5))
+
     @classmethod
     async def init(
             cls,
             endpoint,
-            access_key, 
-            secret_key, 
+            access_key,
+            secret_key,
             bucket_name
         ) -> None:
         cls.endpoint = endpoint
@@ -22,45 +31,59 @@ class Storage():
         cls.bucket_name = bucket_name
         cls.secret_key = secret_key
         cls.s3_session = aioboto3.Session()
+        cls.upload_slots = asyncio.Semaphore(cls.upload_concurrency)
+
+        # One long-lived client, connections are reused between uploads
+        config = Config(max_pool_connections=cls.max_connections,\
+            tcp_keepalive=True, retries={'max_attempts': 0})
+        cls.exit_stack = AsyncExitStack()
+        cls.client = await cls.exit_stack.enter_async_context(cls.s3_session.client('s3',\
+            endpoint_url=cls.endpoint, aws_access_key_id=cls.access_key,\
+            aws_secret_access_key=cls.secret_key, config=config))
+        cls.connected = True
         logging.info('S3 loaded')
 
+    @classmethod
+    async def close(cls) -> None:
+        if cls.connected:
+            cls.connected = False
+            await cls.exit_stack.aclose()
+            cls.client = None
+            logging.info('S3 closed')
+
+    @classmethod
+    async def upload(cls, file_name: str, upload) -> bool:
+        '''Runs upload coroutine factory in a bounded slot, retrying with backoff'''
+        async with cls.upload_slots:
+            for attempt in range(cls.upload_retries + 1):
+                try:
+                    await upload()
+                    logging.info(f'Image {file_name} successfully saved to S3 storage')
+                    return True
+                except Exception as e:
+                    logging.error(f'Cannot save image {file_name} to S3 storage '
+                        f'(attempt {attempt + 1}/{cls.upload_retries + 1}): {e}')
+                if attempt < cls.upload_retries:
+                    await asyncio.sleep(cls.retry_backoff * 2 ** attempt)
+        return False
+
     @classmethod
     async def upload_image_file(
             cls,
             image_path: str,
             file_name: str
         )-> bool:
-        try:
-            # Upload image to S3 storage
-            resource = cls.s3_session.resource('s3', endpoint_url=cls.endpoint,\
-                    aws_access_key_id=cls.access_key, aws_secret_access_key=cls.secret_key)
-            async with resource as s3:
-                bucket = await s3.Bucket(cls.bucket_name)
-                await bucket.upload_file(image_path, file_name, ExtraArgs={'ContentType': 'image/jpeg'})
-            logging.info(f'Image {file_name} successfully saved to S3 storage')
-        except Exception as e:
-            logging.error(f'Cannot save image to S3 storage: {e}')
-        return False
-    
+        # Upload image to S3 storage
+        return await cls.upload(file_name, lambda: cls.client.upload_file(image_path,\
+            cls.bucket_name, file_name, ExtraArgs={'ContentType': 'image/jpeg'}))
+
     @classmethod
     async def upload_image_bytes(
             cls,
             image_bytes: bytes,
-            file_name: str
+            file_name: str,
+            content_type: str = 'image/jpeg'
         )-> bool:
-        try:
-            # Compressing image
-            image_bytes = compress_image(image_bytes)
-            # Upload image to S3 storage
-            resource = cls.s3_session.resource('s3', endpoint_url=cls.endpoint,\
-                    aws_access_key_id=cls.access_key, aws_secret_access_key=cls.secret_key)
-            async with resource as s3:
-                bucket = await s3.Bucket(cls.bucket_name)
-                await bucket.put_object(Body=image_bytes, Key=file_name, ContentType='image/jpeg')
-            logging.info(f'Image {file_name} successfully saved to S3 storage')
-        except Exception as e:
-            logging.error(f'Cannot save image to S3 storage: {e}')
-        return False
-
-
-
+        # Upload image to S3 storage
+        return await cls.upload(file_name, lambda: cls.client.put_object(Body=image_bytes,\
+            Bucket=cls.bucket_name, Key=file_name, ContentType=content_type))
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Modules read settings from env on import
+os.environ.setdefault('SAVE_IMAGES_LOCALLY', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
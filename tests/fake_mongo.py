@@ -0,0 +1,115 @@
+from types import SimpleNamespace
+from bson.objectid import ObjectId
+
+def get_field(document: dict, path: str):
+    for key in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+def matches(document: dict, query: dict) -> bool:
+    '''Subset of MongoDB query language used by `DevoidDatabase`'''
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(document, option) for option in condition):
+                return False
+            continue
+        value = get_field(document, key)
+        if isinstance(condition, dict) and all(op.startswith('$') for op in condition):
+            for op, operand in condition.items():
+                if op == '$ne' and value == operand:
+                    return False
+                if op == '$lt' and (value is None or not value < operand):
+                    return False
+                if op == '$in' and value not in operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+class Cursor():
+    def __init__(self, documents) -> None:
+        self.documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class FakeCollection():
+    '''In-process stand-in for the motor collection methods of the shared queue'''
+
+    def __init__(self) -> None:
+        self.documents = {}
+
+    def update(self, document: dict, update: dict) -> None:
+        document.update(update.get('$set', {}))
+
+    async def find_one_and_update(self, query: dict, update: dict, sort=None, return_document=None):
+        found = [document for document in self.documents.values() if matches(document, query)]
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda document: document[key], reverse=direction < 0)
+        if not found:
+            return None
+        self.update(found[0], update)
+        return dict(found[0])
+
+    async def update_one(self, query: dict, update: dict):
+        for document in self.documents.values():
+            if matches(document, query):
+                self.update(document, update)
+                return SimpleNamespace(matched_count=1)
+        return SimpleNamespace(matched_count=0)
+
+    async def update_many(self, query: dict, update: dict):
+        found = [document for document in self.documents.values() if matches(document, query)]
+        for document in found:
+            self.update(document, update)
+        return SimpleNamespace(matched_count=len(found))
+
+    async def find_one_and_delete(self, query: dict, sort=None):
+        found = [document for document in self.documents.values() if matches(document, query)]
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda document: document[key], reverse=direction < 0)
+        if not found:
+            return None
+        return self.documents.pop(found[0]['_id'])
+
+    async def insert_one(self, document: dict):
+        document.setdefault('_id', ObjectId())
+        self.documents[document['_id']] = dict(document)
+        return SimpleNamespace(inserted_id=document['_id'])
+
+    async def delete_one(self, query: dict):
+        for id, document in self.documents.items():
+            if matches(document, query):
+                del self.documents[id]
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    def find(self, query: dict, projection: dict = None) -> Cursor:
+        return Cursor([dict(document) for document in self.documents.values() if matches(document, query)])
+
+    def aggregate(self, pipeline: list) -> Cursor:
+        '''Only `$match` followed by `$group` of `queue_stats`'''
+        match, group = pipeline[0]['$match'], pipeline[1]['$group']
+        groups = {}
+        for document in self.documents.values():
+            if not matches(document, match):
+                continue
+            id = {name: get_field(document, path[1:]) for name, path in group['_id'].items()}
+            key = tuple(sorted(id.items()))
+            result = groups.setdefault(key, {'_id': id, 'count': 0, 'work': 0})
+            result['count'] += 1
+            result['work'] += document['work']
+        return Cursor(list(groups.values()))
+
+class FakeDatabase():
+    def __init__(self) -> None:
+        self.queue = FakeCollection()
+        self.queue_messages = FakeCollection()
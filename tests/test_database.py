@@ -0,0 +1,29 @@
+import asyncio
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+from utils.database import DevoidDatabase
+
+class FailingRequests():
+    '''Bulk write failing operations at given indexes with given codes'''
+
+    def __init__(self, errors: dict) -> None:
+        self.errors = errors
+
+    async def bulk_write(self, operations, ordered=True):
+        raise BulkWriteError({'writeErrors': [{'index': index, 'code': code, 'errmsg': 'failed'}\
+            for index, code in self.errors.items()]})
+
+def test_flush_requeues_only_retryable_write_errors(monkeypatch):
+    async def main():
+        database = type('Database', (), {'requests': FailingRequests({1: 11000, 2: 10334})})()
+        monkeypatch.setattr(DevoidDatabase, '_DevoidDatabase__database', database, raising=False)
+        monkeypatch.setattr(DevoidDatabase, '_DevoidDatabase__pending', {})
+        written, retried, dropped = ObjectId(), ObjectId(), ObjectId()
+        for id in (written, retried, dropped):
+            DevoidDatabase.write_request(id, {'gen_status': 'ok'})
+
+        await DevoidDatabase.flush()
+        assert list(DevoidDatabase._DevoidDatabase__pending) == [retried]
+    asyncio.run(main())
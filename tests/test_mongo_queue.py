@@ -0,0 +1,245 @@
+import asyncio
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from enums import ExecutorType, GenStatus, Service
+from image_gen.request import GenerationRequest
+from image_gen.mongo_queue import MongoRequestQueue
+from utils.database import DevoidDatabase
+
+from fake_mongo import FakeDatabase
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(DevoidDatabase, '_DevoidDatabase__database', database, raising=False)
+    monkeypatch.setattr(DevoidDatabase, 'write_request', classmethod(lambda cls, id, fields: None))
+    return database
+
+async def send(service, json_message, data=None, labels=None):
+    pass
+
+def make_request(premium: bool = False) -> GenerationRequest:
+    return GenerationRequest(Service.TEST, {
+        'message_type': 'request',
+        'executor': 'automatic1111',
+        'gen_type': 'text2img',
+        'settings': {'premium': premium},
+        'service_info': {},
+        'payload': {'prompt': 'test'}
+    }, send)
+
+def make_queue(lease: float = 30) -> MongoRequestQueue:
+    queue = MongoRequestQueue(ExecutorType.AUTOMATIC1111, (1, 1))
+    queue.ws_handler = send
+    queue.lease = lease
+    queue.poll_interval = 0.01
+    return queue
+
+async def enqueue(queue: MongoRequestQueue, *requests: GenerationRequest) -> None:
+    for request in requests:
+        queue.put_general(request)
+        # Insert runs as a task, order must follow puts
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(0)
+
+def test_claims_oldest_request(database):
+    async def main():
+        queue = make_queue()
+        first, second = make_request(), make_request()
+        await enqueue(queue, first, second)
+
+        claimed = await queue.get_request(1)
+        assert claimed.object_id == first.object_id
+        document = database.queue.documents[first.object_id]
+        assert document['status'] == 'leased'
+        assert document['owner'] == queue.owner
+        assert claimed.object_id in queue.leased
+    asyncio.run(main())
+
+def test_expired_lease_is_claimed_by_another_process(database):
+    async def main():
+        crashed, alive = make_queue(), make_queue()
+        request = make_request()
+        await enqueue(crashed, request)
+        assert (await crashed.get_request(1)).object_id == request.object_id
+
+        # Lease is held, nothing to claim
+        assert await alive.get_request(0.05) is None
+
+        database.queue.documents[request.object_id]['lease_until'] = datetime.utcnow() - timedelta(seconds=1)
+        claimed = await alive.get_request(1)
+        assert claimed.object_id == request.object_id
+        assert database.queue.documents[request.object_id]['owner'] == alive.owner
+    asyncio.run(main())
+
+def test_heartbeat_renews_leases(database):
+    async def main():
+        queue, other = make_queue(lease=0.3), make_queue()
+        request = make_request()
+        await enqueue(queue, request)
+        await queue.get_request(1)
+
+        queue.start(asyncio.get_running_loop())
+        try:
+            # Outlives the initial lease several times
+            await asyncio.sleep(0.8)
+            document = database.queue.documents[request.object_id]
+            assert document['lease_until'] > datetime.utcnow()
+            assert await other.get_request(0.05) is None
+        finally:
+            queue.heartbeat.cancel()
+            queue.relay.cancel()
+    asyncio.run(main())
+
+def test_put_back_keeps_order(database):
+    async def main():
+        queue = make_queue()
+        first, second = make_request(), make_request()
+        await enqueue(queue, first, second)
+
+        claimed = await queue.get_request(1)
+        queue.put_back(claimed)
+        await asyncio.sleep(0)
+        document = database.queue.documents[first.object_id]
+        assert document['status'] == 'queued' and document['owner'] is None
+
+        assert (await queue.get_request(1)).object_id == first.object_id
+        assert (await queue.get_request(1)).object_id == second.object_id
+    asyncio.run(main())
+
+def test_complete_removes_document(database):
+    async def main():
+        queue = make_queue()
+        await enqueue(queue, make_request())
+        request = await queue.get_request(1)
+        queue.complete(request)
+        await asyncio.sleep(0)
+        assert not database.queue.documents
+        assert not queue.leased
+    asyncio.run(main())
+
+def test_cancel_id_removes_queued_request(database):
+    async def main():
+        queue = make_queue()
+        request = make_request()
+        await enqueue(queue, request)
+
+        assert await queue.cancel_id(request.object_id, Service.TEST)
+        assert request.object_id not in database.queue.documents
+        assert await queue.get_request(0.05) is None
+    asyncio.run(main())
+
+def test_cancel_id_flags_leased_request_for_its_owner(database):
+    async def main():
+        owner, other = make_queue(lease=0.3), make_queue()
+        request = make_request()
+        await enqueue(owner, request)
+        claimed = await owner.get_request(1)
+        claimed.gen_status = GenStatus.GENERATING
+
+        assert await other.cancel_id(request.object_id, Service.TEST)
+        assert database.queue.documents[request.object_id]['cancelled'] is True
+
+        # Owner picks the flag up with its next heartbeat
+        owner.start(asyncio.get_running_loop())
+        try:
+            await asyncio.sleep(0.05)
+            assert claimed.cancelled
+            assert claimed.gen_status == GenStatus.CANCELLED
+        finally:
+            owner.heartbeat.cancel()
+            owner.relay.cancel()
+
+        # Flagged request is never claimed again
+        database.queue.documents[request.object_id]['lease_until'] = datetime.utcnow() - timedelta(seconds=1)
+        assert await other.get_request(0.05) is None
+    asyncio.run(main())
+
+def test_cancel_id_of_unknown_request(database):
+    async def main():
+        assert not await make_queue().cancel_id(make_request().object_id, Service.TEST)
+    asyncio.run(main())
+
+def test_state_of_claimed_request_is_relayed_to_accepting_process(database):
+    async def main():
+        accepting, claiming = make_queue(), make_queue()
+        received = []
+        async def deliver(service, json_message, data=None, labels=None):
+            received.append((service, json_message, data))
+        accepting.ws_handler = deliver
+
+        request = make_request()
+        await enqueue(accepting, request)
+        claimed = await claiming.get_request(1)
+        claimed.gen_status = GenStatus.GENERATING
+        await claimed.send_to_client()
+        assert database.queue_messages.documents
+
+        accepting.start(asyncio.get_running_loop())
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            accepting.heartbeat.cancel()
+            accepting.relay.cancel()
+        assert not database.queue_messages.documents
+        [(service, json_message, data)] = received
+        assert service == Service.TEST
+        assert json_message['object_id'] == str(request.object_id)
+        assert json_message['gen_status'] == GenStatus.GENERATING.value
+    asyncio.run(main())
+
+def test_cancel_id_of_another_service(database):
+    async def main():
+        queue = make_queue()
+        request = make_request()
+        await enqueue(queue, request)
+
+        assert not await queue.cancel_id(request.object_id, Service.DISCORD)
+        assert database.queue.documents[request.object_id]['status'] == 'queued'
+        assert not database.queue.documents[request.object_id].get('cancelled')
+    asyncio.run(main())
+
+def test_cancel_of_unclaimed_request(database):
+    async def main():
+        queue = make_queue()
+        request = make_request()
+        sent = []
+        async def capture(service, json_message, data=None, labels=None):
+            sent.append(json_message['gen_status'])
+        request.ws_handler = capture
+        await enqueue(queue, request)
+
+        assert await request.cancel()
+        assert request.object_id not in database.queue.documents
+        assert request.gen_status == GenStatus.CANCELLED and request.queue is None
+        assert sent == [GenStatus.CANCELLED.value]
+        assert not await request.cancel()
+    asyncio.run(main())
+
+def test_cancel_of_claimed_request_leaves_accepted_copy(database):
+    async def main():
+        accepting, claiming = make_queue(), make_queue()
+        request = make_request()
+        await enqueue(accepting, request)
+        await claiming.get_request(1)
+
+        # Claiming process sends the cancelled state
+        assert await request.cancel()
+        assert database.queue.documents[request.object_id]['cancelled'] is True
+        assert request.gen_status == GenStatus.QUEUED and not request.cancelled
+    asyncio.run(main())
+
+def test_cancel_of_finished_request(database):
+    async def main():
+        accepting, claiming = make_queue(), make_queue()
+        request = make_request()
+        await enqueue(accepting, request)
+        claiming.complete(await claiming.get_request(1))
+        await asyncio.sleep(0)
+
+        assert not await request.cancel('Deadline of 1s exceeded')
+        assert request.gen_status == GenStatus.QUEUED and not request.cancelled
+    asyncio.run(main())